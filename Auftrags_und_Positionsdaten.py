@@ -1,24 +1,64 @@
-import re, json
+import os, json, shutil, hashlib, argparse, threading, tempfile
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from typing import NamedTuple
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import streamlit as st
-from data_loader import load_Auftragsdaten, load_Positionsdaten
+from data_loader import (
+    load_handwerker_dimension, bereinigt_aktuell, build_Auftragsdaten_bereinigt,
+    AUFTRAGSDATEN_PFAD, AUFTRAGSDATEN_BEREINIGT_PFAD, POSITIONSDATEN_PFAD, BEREINIGUNG_VERSION,
+)
+from Preiszuverlaessigkeit import verhaeltnis
 
 BASIS_ORDNER = Path("/Users/benab/Desktop/Projekt")
-ORDNER_GEWERK = BASIS_ORDNER / "Auftrags_und_Positionsdaten_Gewerk"
-ORDNER_SCHADENSFALL = BASIS_ORDNER / "Auftrags_und_Positionsdaten_Schadensfall"
-ORDNER_FALLTYP = BASIS_ORDNER / "Auftrags_und_Positionsdaten_Falltypen"
+ORDNER_DATASET = BASIS_ORDNER / "Auftrags_und_Positionsdaten"
 INDEX_FILE = BASIS_ORDNER / "index_lists.json"
+MANIFEST_FILE = BASIS_ORDNER / "dataset_manifest.json"
+AGGREGAT_FILE = BASIS_ORDNER / "Handwerker_Aggregate.parquet"
+# Zwischenablage der Quelle für die Worker-Prozesse (nur während des Builds vorhanden)
+BUILD_QUELLE_FILE = BASIS_ORDNER / "build_quelle.arrow"
+BUILD_POSITIONEN_FILE = BASIS_ORDNER / "build_positionen.arrow"
+
+# Bei Änderungen an Bereinigung/Merge hochzählen -> erzwingt vollständigen Neuaufbau
+BUILD_VERSION = 5
+
+# Ein Dataset statt drei Kopien: Hive-partitioniert nach Schadenart/Falltyp,
+# innerhalb der Partitionen nach Gewerk sortiert (Row-Group-Statistiken fürs Filtern)
+PARTITIONIERUNG = ds.partitioning(
+    pa.schema([("Schadenart_Name", pa.string()), ("Falltyp_Name", pa.string())]),
+    flavor="hive",
+)
+PARTITION_SPALTEN = ["Schadenart_Name", "Falltyp_Name"]
+ROW_GROUP_GROESSE = 50_000
+# Feinste Ebene, auf der die Dashboard-Filter greifen -> Summen/Anzahlen sind frei aufaddierbar.
+# Gruppiert wird über die int32-ID, Name/PLZ/Land kommen danach aus der Handwerker-Dimension
+AGGREGAT_SCHLUESSEL = ["HW_ID", "Gewerk_Name", "Schadenart_Name", "Falltyp_Name"]
+# kein "\x00" als Platzhalter: pandas kürzt Objekt-Strings beim Gruppieren am NUL-Zeichen
+KEY_SEP, KEY_NULL = "\x1f", "\x1e"
 
-SAFE_RE = re.compile(r'[\/\\\?\*\:\|\<\>"]')
 RELEVANTE_SPALTEN = [
-    "Handwerker_Name", "PLZ_HW", "Land",
+    "HW_ID", "Handwerker_Name", "PLZ_HW", "Land",
     "Gewerk_Name", "Schadenart_Name", "Falltyp_Name",
     "Einigung_Netto", "Forderung_Netto",
 ]
+# Spalten aus Positionsdaten, die zusätzlich ins Dataset sollen. Dashboard, Aggregat und Index lesen nur
+# Auftragsdaten-Spalten -> leer, dann wird von Positionsdaten nur KvaRechnung_ID gestreamt (kein Join)
+POSITIONS_SPALTEN: list[str] = []
+JOIN_BLOCK_ZEILEN = 500_000        # Positionszeilen je Hash-Bucket (so viele liegen beim Join höchstens im Speicher)
 
-def make_safe(x) -> str:
-    return SAFE_RE.sub("_", str(x)).strip()
+# Gestreamter Build: Quelle in Batches lesen, je Partition höchstens eine Row-Group puffern
+BATCH_ZEILEN = 200_000
+PUFFER_MAX_ZEILEN = 2_000_000       # Obergrenze über alle Partitionspuffer, darüber wird der größte ausgelagert
+AGGREGAT_PUFFER_ZEILEN = 1_000_000  # Teilsummen werden verdichtet, sobald sie so viele Zeilen haben
+SCHREIB_THREADS = min(8, os.cpu_count() or 1)
+POS_ANZAHL = "_positionen"          # Positionen je Auftragszeile, in der Zwischenablage mitgeführt
 
 def load_index() -> dict:
     return json.loads(INDEX_FILE.read_text("utf-8")) if INDEX_FILE.exists() else \
@@ -28,44 +68,471 @@ def write_index(gewerke, schadensarten, falltypen_map) -> None:
     INDEX_FILE.write_text(json.dumps({
         "gewerke": sorted(set(gewerke)),
         "schadensarten": sorted(set(schadensarten)),
-        "falltypen_by_schadensart": {k: sorted(set(v)) for k, v in falltypen_map.items()},
+        "falltypen_by_schadensart": {k: sorted(set(v)) for k, v in sorted(falltypen_map.items())},
     }, ensure_ascii=False, indent=2), "utf-8")
 
-def subset(df: pd.DataFrame) -> pd.DataFrame:
-    cols = [c for c in RELEVANTE_SPALTEN if c in df.columns]
-    return df[cols].copy()
+def quell_fingerprint() -> str:
+    # Dateiinhalt streamend hashen: Footer-Statistiken (Zeilen, Größe, Min/Max) übersehen Änderungen
+    # innerhalb einer Row-Group, z.B. einen geänderten Betrag oder eine verschobene Zeile
+    h = hashlib.sha1(f"v{BUILD_VERSION}|b{BEREINIGUNG_VERSION}".encode())
+    for pfad in (AUFTRAGSDATEN_PFAD, POSITIONSDATEN_PFAD):
+        h.update(f"{os.path.getsize(pfad)}|".encode())
+        with open(pfad, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
 
-def generate_parquet_files() -> None:
-    for d in (ORDNER_GEWERK, ORDNER_SCHADENSFALL, ORDNER_FALLTYP):
-        d.mkdir(parents=True, exist_ok=True)
+def load_manifest() -> dict:
+    return json.loads(MANIFEST_FILE.read_text("utf-8")) if MANIFEST_FILE.exists() else {}
 
-    auftrag, pos = load_Auftragsdaten(), load_Positionsdaten()
-    drop_cols = [c for c in pos.columns if c in auftrag.columns and c != "KvaRechnung_ID"]
-    merged = auftrag.merge(pos.drop(columns=drop_cols), on="KvaRechnung_ID", how="left")
+def partition_schluessel(df: pd.DataFrame) -> pd.Series:
+    teile = [df[c].astype("string").fillna(KEY_NULL) for c in PARTITION_SPALTEN]
+    key = teile[0]
+    for t in teile[1:]:
+        key = key + KEY_SEP + t
+    return key
 
-    gewerke, schadensarten, falltypen_map = [], [], {}
-    
-    def dump_groups(group_cols, out_dir: Path, collect=None):
-        for key, grp in merged.groupby(group_cols):
-            if (isinstance(key, tuple) and any(pd.isna(k) for k in key)) or pd.isna(key):
-                continue
+def partition_hashes(df: pd.DataFrame, schluessel: pd.Series) -> pd.DataFrame:
+    # Summe der Zeilen-Hashes (mod 2^64) ist unabhängig von der Zeilenreihenfolge -> über Batches aufaddierbar
+    zeilen = pd.util.hash_pandas_object(df, index=False)
+    return zeilen.groupby(schluessel.to_numpy()).agg(["sum", "size"])
+
+def _partition_filter(key: str) -> ds.Expression:
+    expr = None
+    for c, v in zip(PARTITION_SPALTEN, key.split(KEY_SEP)):
+        e = ds.field(c).is_null() if v == KEY_NULL else (ds.field(c) == v)
+        expr = e if expr is None else expr & e
+    return expr
+
+def loesche_partitionen(wurzel: Path, keys) -> None:
+    dataset = ds.dataset(wurzel, format="parquet", partitioning=PARTITIONIERUNG)
+    for key in keys:
+        for frag in dataset.get_fragments(filter=_partition_filter(key)):
+            pfad = Path(frag.path)
+            pfad.unlink(missing_ok=True)
+            for ordner in (pfad.parent, pfad.parent.parent):
+                if ordner != wurzel and ordner.exists() and not any(ordner.iterdir()):
+                    ordner.rmdir()
+
+def _verlinke(quelle: str, ziel: str) -> None:
+    # Hardlink statt Kopie; Dateisysteme ohne Hardlinks bekommen eine echte Kopie
+    try:
+        os.link(quelle, ziel)
+    except OSError:
+        shutil.copy2(quelle, ziel)
+
+def tausche_dataset(neu: Path) -> None:
+    # os.replace kann kein Verzeichnis über ein nicht-leeres schieben: das alte Dataset erst beiseite,
+    # dann das neue an seinen Platz (zwei Renames im selben Ordner, keine Kopie)
+    alt = ORDNER_DATASET.with_name(ORDNER_DATASET.name + ".alt")
+    if alt.exists():
+        shutil.rmtree(alt)
+    if ORDNER_DATASET.exists():
+        os.replace(ORDNER_DATASET, alt)
+    os.replace(neu, ORDNER_DATASET)
+    shutil.rmtree(alt, ignore_errors=True)
+
+def positionen_je_rechnung() -> pd.Series:
+    # Nur die Schlüsselspalte batchweise lesen und zählen -> Speicher ~ Anzahl verschiedener Rechnungen
+    teile = [
+        pa.Table.from_struct_array(pc.value_counts(batch.column(0)))
+        for batch in pq.ParquetFile(POSITIONSDATEN_PFAD).iter_batches(columns=["KvaRechnung_ID"])
+    ]
+    if not teile:
+        return pd.Series(dtype="int64")
+    anzahl = pa.concat_tables(teile).group_by("values").aggregate([("counts", "sum")])
+    return pd.Series(anzahl["counts_sum"].to_numpy(), index=anzahl["values"].to_pandas())
+
+def anzahl_positionen(kva_ids: pd.Series, anzahl: pd.Series) -> np.ndarray:
+    # Rechnungen ohne Positionen zählen einmal (wie beim Left-Merge)
+    return kva_ids.map(anzahl).fillna(1).astype("int64").to_numpy()
+
+def vervielfache_je_position(auftrag: pd.DataFrame, n: np.ndarray) -> pd.DataFrame:
+    # Gleiche Zeilen wie ein Left-Merge mit Positionsdaten, aber ohne den Join:
+    # jede Auftragszeile so oft wie ihre Rechnung Positionen hat
+    return auftrag.iloc[np.repeat(np.arange(len(auftrag)), n)].reset_index(drop=True)
+
+def _klartext(batch: pa.RecordBatch) -> dict[str, pa.Array]:
+    # Kategorien als Klartext: eine IPC-Datei erlaubt keine je Batch wechselnden Dictionaries
+    return {
+        name: spalte.dictionary_decode() if pa.types.is_dictionary(spalte.type) else spalte
+        for name, spalte in zip(batch.schema.names, batch.columns)
+    }
+
+def positions_id_typ() -> pa.DataType:
+    typ = pq.read_schema(POSITIONSDATEN_PFAD).field("KvaRechnung_ID").type
+    return typ.value_type if pa.types.is_dictionary(typ) else typ
+
+def id_bucket(ids: pa.Array, typ: pa.DataType, n: int) -> np.ndarray:
+    # Hash-Bucket je KvaRechnung_ID; beide Seiten werden auf den Typ aus Positionsdaten gebracht,
+    # damit gleiche IDs im gleichen Bucket landen. NULL -> Bucket 0 (der Left-Merge paart NaN mit NaN)
+    bucket = np.zeros(len(ids), dtype="int64")
+    if n > 1:
+        ids = pc.cast(ids, typ)
+        gueltig = ids.is_valid().to_numpy(zero_copy_only=False)
+        werte = ids.drop_null().to_numpy(zero_copy_only=False)
+        bucket[gueltig] = (pd.util.hash_array(werte) % np.uint64(n)).astype("int64")
+    return bucket
+
+class PositionsBuckets(NamedTuple):
+    pfad: str                   # IPC-Datei mit KvaRechnung_ID und den Positions-Spalten
+    batches: list[list[int]]    # je Bucket die Nummern seiner Record-Batches
+
+def stage_positionen(pfad: Path, spalten: list[str], typ: pa.DataType) -> PositionsBuckets:
+    # Positionsdaten einmal nach Hash-Bucket der KvaRechnung_ID aufteilen (Grace-Hash-Join): je Bucket
+    # höchstens etwa JOIN_BLOCK_ZEILEN Zeilen, je Quell-Batch ein Record-Batch pro Bucket
+    quelle = pq.ParquetFile(POSITIONSDATEN_PFAD)
+    n = max(1, -(-quelle.metadata.num_rows // JOIN_BLOCK_ZEILEN))
+    felder = [quelle.schema_arrow.field(c) for c in ["KvaRechnung_ID", *spalten]]
+    schema = pa.schema([f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in felder])
+    batches_je_bucket: list[list[int]] = [[] for _ in range(n)]
+    nr = 0
+    with pa.ipc.new_file(str(pfad), schema) as writer:
+        for batch in quelle.iter_batches(batch_size=BATCH_ZEILEN, columns=schema.names):
+            batch = pa.RecordBatch.from_pydict(_klartext(batch), schema=schema)
+            buckets = id_bucket(batch.column(0), typ, n)
+            for b in np.unique(buckets):
+                writer.write_batch(batch.filter(pa.array(buckets == b)))
+                batches_je_bucket[b].append(nr)
+                nr += 1
+    return PositionsBuckets(str(pfad), batches_je_bucket)
+
+class PartitionSchreiber:
+    """Schreibt gestreamte Zeilen in eine Parquet-Datei je Schadenart/Falltyp-Partition.
+
+    Je Partition wird höchstens eine Row-Group gepuffert; volle Puffer gehen an einen Thread-Pool.
+    Eine Partition hängt fest an einem Thread, damit ihr ParquetWriter nie parallel benutzt wird.
+    Übersteigen alle Puffer zusammen PUFFER_MAX_ZEILEN, wird der größte in eine temporäre IPC-Datei
+    ausgelagert statt als kleine Row-Group geschrieben; geschrieben werden nur ganze Row-Groups
+    (und am Ende je Partition der Rest).
+    """
+
+    def __init__(self, ordner: Path, max_parallel: int = SCHREIB_THREADS):
+        self.ordner = ordner
+        self.spill_ordner = Path(tempfile.mkdtemp(prefix=".spill_", dir=ordner.parent))
+        self.spill: dict[str, tuple[Path, pa.ipc.RecordBatchStreamWriter]] = {}
+        self.gespillt: dict[str, int] = {}
+        self.spill_nr = 0
+        self.pools = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="parquet") for _ in range(max_parallel)]
+        # Begrenzt die Row-Groups, die auf einen Thread warten -> Speicher bleibt beschränkt
+        self.unterwegs = threading.BoundedSemaphore(2 * max_parallel)
+        self.schema = None
+        self.puffer: dict[str, list[pa.Table]] = {}
+        self.gepuffert: dict[str, int] = {}
+        self.writer: dict[str, pq.ParquetWriter] = {}
+        self.futures = []
+
+    def schreibe(self, key: str, df: pd.DataFrame) -> None:
+        tabelle = pa.Table.from_pandas(df.drop(columns=PARTITION_SPALTEN), preserve_index=False)
+        if self.schema is None:
+            # Kategorien je Batch unterschiedlich -> einheitlich als Klartext-Spalten schreiben
+            self.schema = pa.schema([
+                f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in tabelle.schema
+            ])
+        self.puffer.setdefault(key, []).append(tabelle.cast(self.schema))
+        self.gepuffert[key] = self.gepuffert.get(key, 0) + len(tabelle)
+        if self.gepuffert[key] + self.gespillt.get(key, 0) >= ROW_GROUP_GROESSE:
+            self._flush(key, nur_volle=True)
+        if sum(self.gepuffert.values()) > PUFFER_MAX_ZEILEN:
+            self._auslagern(max(self.gepuffert, key=self.gepuffert.get))
+
+    def _auslagern(self, key: str) -> None:
+        # Puffer auf die Platte statt als Mini-Row-Group ins Dataset
+        teile, n = self.puffer.pop(key, []), self.gepuffert.pop(key, 0)
+        if key not in self.spill:
+            self.spill_nr += 1
+            pfad = self.spill_ordner / f"{self.spill_nr}.arrow"
+            self.spill[key] = (pfad, pa.ipc.new_stream(str(pfad), self.schema))
+        for t in teile:
+            self.spill[key][1].write_table(t)
+        self.gespillt[key] = self.gespillt.get(key, 0) + n
+
+    def _flush(self, key: str, nur_volle: bool = False) -> None:
+        teile, n = self.puffer.pop(key, []), self.gepuffert.pop(key, 0)
+        if key in self.spill:
+            # Ausgelagertes zurückholen: zusammen höchstens gut eine Row-Group
+            pfad, writer = self.spill.pop(key)
+            writer.close()
+            with pa.OSFile(str(pfad)) as quelle:
+                teile.insert(0, pa.ipc.open_stream(quelle).read_all().combine_chunks())
+            pfad.unlink()
+            n += self.gespillt.pop(key)
+        if not n:
+            return
+        tabelle = pa.concat_tables(teile)
+        if nur_volle and n % ROW_GROUP_GROESSE:
+            # nur ganze Row-Groups schreiben, der Rest bleibt gepuffert (sonst entstehen Mini-Row-Groups)
+            voll = n - n % ROW_GROUP_GROESSE
+            self.puffer[key], self.gepuffert[key] = [tabelle.slice(voll)], n - voll
+            tabelle = tabelle.slice(0, voll)
+        # innerhalb der Row-Group nach Gewerk sortieren -> enge Min/Max-Statistiken fürs Filtern
+        tabelle = tabelle.take(pc.sort_indices(tabelle, sort_keys=[("Gewerk_Name", "ascending")]))
+        self.unterwegs.acquire()
+        pool = self.pools[hash(key) % len(self.pools)]
+        self.futures.append(pool.submit(self._schreibe_row_groups, key, tabelle))
+
+    def _schreibe_row_groups(self, key: str, tabelle: pa.Table) -> None:
+        try:
+            writer = self.writer.get(key)
+            if writer is None:
+                ordner = self.ordner / PARTITIONIERUNG.format(_partition_filter(key))[0]
+                ordner.mkdir(parents=True, exist_ok=True)
+                # Eine per Hardlink übernommene Datei nie überschreiben, sonst ändert sich das live Dataset mit
+                (ordner / "part-0.parquet").unlink(missing_ok=True)
+                writer = self.writer[key] = pq.ParquetWriter(ordner / "part-0.parquet", self.schema)
+            writer.write_table(tabelle, row_group_size=ROW_GROUP_GROESSE)
+        finally:
+            self.unterwegs.release()
+
+    def schliessen(self) -> None:
+        try:
+            for key in set(self.puffer) | set(self.spill):
+                self._flush(key)
+            for f in self.futures:
+                f.result()
+        finally:
+            for pool in self.pools:
+                pool.shutdown()
+            for writer in self.writer.values():
+                writer.close()
+            for _, writer in self.spill.values():
+                writer.close()
+            shutil.rmtree(self.spill_ordner, ignore_errors=True)
+
+class BuildStand(NamedTuple):
+    hashes: dict[str, str]
+    aggregat: pd.DataFrame      # Teilsummen je AGGREGAT_SCHLUESSEL, noch ohne Handwerker-Stammdaten
+    gewerke: set
+    falltypen_map: dict[str, set]
+
+def _verdichte(teile: list[pd.DataFrame]) -> pd.DataFrame:
+    if not teile:
+        return pd.DataFrame(columns=[*AGGREGAT_SCHLUESSEL, "verhaeltnis_summe", "n_jobs"])
+    return (
+        pd.concat(teile, ignore_index=True)
+        .groupby(AGGREGAT_SCHLUESSEL, dropna=False, observed=True)[["verhaeltnis_summe", "n_jobs"]].sum()
+        .reset_index()
+    )
 
-            if not isinstance(key, tuple):
-                grp.to_parquet(out_dir / f"{make_safe(key)}.parquet", index=False)
-                if collect is not None:
-                    collect.append(str(key))
+def auftrag_bloecke(reader: pa.ipc.RecordBatchFileReader, batches_je_bucket: list[list[int]],
+                    positionen: PositionsBuckets | None) -> Iterator[pd.DataFrame]:
+    # Bucket für Bucket: Positionen des Buckets einmal laden, die Auftrags-Batches desselben Buckets zu Blöcken
+    # von etwa BATCH_ZEILEN Zeilen zusammenfassen und per Left-Merge anfügen. Ohne Positions-Spalten
+    # wird jede Auftragszeile nur so oft wiederholt, wie ihre Rechnung Positionen hat.
+    pos_reader = pa.ipc.open_file(pa.memory_map(positionen.pfad)) if positionen is not None else None
+    for b, nrn in enumerate(batches_je_bucket):
+        if not nrn:
+            continue
+        if pos_reader is not None:
+            pos = pa.Table.from_batches(
+                [pos_reader.get_batch(i) for i in positionen.batches[b]], schema=pos_reader.schema
+            ).to_pandas()
+        block, zeilen = [], 0
+        for i, nr in enumerate(nrn):
+            block.append(reader.get_batch(nr))
+            zeilen += block[-1].num_rows
+            if zeilen < BATCH_ZEILEN and i + 1 < len(nrn):
+                continue
+            df = pa.Table.from_batches(block).to_pandas()
+            block, zeilen = [], 0
+            if pos_reader is not None:
+                yield df.merge(pos, on="KvaRechnung_ID", how="left")
             else:
-                s, f = map(str, key)
-                falltypen_map.setdefault(s, []).append(f)
-                d = out_dir / make_safe(s)
-                d.mkdir(exist_ok=True)
-                grp.to_parquet(d / f"{make_safe(f)}.parquet", index=False)
+                yield vervielfache_je_position(df.drop(columns=POS_ANZAHL), df[POS_ANZAHL].to_numpy())
+
+def durchlaufe_quelle(bloecke: Iterable[pd.DataFrame], schreiber: PartitionSchreiber | None = None,
+                      nur_partitionen: set[str] | None = None) -> BuildStand:
+    # Blöcke (schon mit Positionen) verarbeiten und Hashes, Aggregat und Index fortschreiben.
+    # Im Speicher liegt immer nur ein Block plus die Puffer des Schreibers.
+    summen: dict[str, list[int]] = {}
+    agg_teile, agg_zeilen = [], 0
+    gewerke, falltypen_map = set(), {}
+
+    for df in bloecke:
+        schluessel = partition_schluessel(df)
+
+        teil = partition_hashes(df, schluessel)
+        for key, s, n in zip(teil.index, teil["sum"], teil["size"]):
+            alt = summen.setdefault(key, [0, 0])
+            alt[0], alt[1] = (alt[0] + int(s)) % 2**64, alt[1] + int(n)
+
+        agg_teile.append(
+            df[AGGREGAT_SCHLUESSEL].assign(verhaeltnis_summe=verhaeltnis(df), n_jobs=1)
+            .groupby(AGGREGAT_SCHLUESSEL, dropna=False, observed=True)[["verhaeltnis_summe", "n_jobs"]].sum()
+            .reset_index()
+        )
+        agg_zeilen += len(agg_teile[-1])
+        if agg_zeilen > AGGREGAT_PUFFER_ZEILEN:
+            agg_teile = [_verdichte(agg_teile)]
+            agg_zeilen = len(agg_teile[0])
+
+        gewerke.update(df["Gewerk_Name"].dropna().astype(str))
+        paare = df[["Schadenart_Name", "Falltyp_Name"]].dropna().drop_duplicates().astype(str)
+        for schaden, falltyp in paare.itertuples(index=False):
+            falltypen_map.setdefault(schaden, set()).add(falltyp)
+
+        if schreiber is not None:
+            for key, zeilen in schluessel.groupby(schluessel.to_numpy(), sort=False).indices.items():
+                if nur_partitionen is None or key in nur_partitionen:
+                    schreiber.schreibe(key, df.iloc[zeilen])
+
+    hashes = {k: f"{s:016x}-{n}" for k, (s, n) in summen.items()}
+    return BuildStand(hashes, _verdichte(agg_teile), gewerke, falltypen_map)
+
+def zaehle_partitionen(anzahl: pd.Series | None) -> dict[str, int]:
+    # Vorab nur Partitionsspalten und KvaRechnung_ID lesen: Zeilen je Partition für die Lastverteilung
+    zeilen: dict[str, int] = {}
+    quelle = pq.ParquetFile(AUFTRAGSDATEN_BEREINIGT_PFAD)
+    for batch in quelle.iter_batches(batch_size=BATCH_ZEILEN, columns=["KvaRechnung_ID", *PARTITION_SPALTEN]):
+        df = batch.to_pandas()
+        n = np.ones(len(df), dtype="int64") if anzahl is None else anzahl_positionen(df["KvaRechnung_ID"], anzahl)
+        for key, summe in pd.Series(n).groupby(partition_schluessel(df).to_numpy()).sum().items():
+            zeilen[key] = zeilen.get(key, 0) + int(summe)
+    return zeilen
+
+def stage_quelle(pfad: Path, anzahl: pd.Series | None, los_von: dict[str, int], n_lose: int,
+                 positionen: PositionsBuckets | None = None, typ: pa.DataType | None = None) -> list[list[list[int]]]:
+    # Quelle einmal als unkomprimierte Arrow-IPC-Datei ablegen, je Quell-Batch ein Record-Batch pro
+    # (Worker-Los, ID-Bucket). Die Worker mappen die Datei in den Speicher und lesen nur ihre eigenen Batches:
+    # ohne Kopie, ohne Filter. Liefert je Los und Bucket die Nummern der Record-Batches.
+    n_buckets = len(positionen.batches) if positionen is not None else 1
+    batches_je_los = [[[] for _ in range(n_buckets)] for _ in range(n_lose)]
+    writer, nr = None, 0
+    try:
+        quelle = pq.ParquetFile(AUFTRAGSDATEN_BEREINIGT_PFAD)
+        for batch in quelle.iter_batches(batch_size=BATCH_ZEILEN, columns=["KvaRechnung_ID"] + RELEVANTE_SPALTEN):
+            spalten = _klartext(batch)
+            if anzahl is not None:
+                spalten[POS_ANZAHL] = pa.array(anzahl_positionen(spalten["KvaRechnung_ID"].to_pandas(), anzahl))
+            batch = pa.RecordBatch.from_pydict(spalten)
+            if writer is None:
+                writer = pa.ipc.new_file(str(pfad), batch.schema)
+
+            lose = partition_schluessel(batch.select(PARTITION_SPALTEN).to_pandas()).map(los_von).to_numpy()
+            teile = lose * n_buckets + id_bucket(batch.column(0), typ, n_buckets)
+            for teil in np.unique(teile):
+                writer.write_batch(batch.filter(pa.array(teile == teil)))
+                batches_je_los[teil // n_buckets][teil % n_buckets].append(nr)
+                nr += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return batches_je_los
+
+def baue_partitionen(quelle_pfad: str, batches_je_bucket: list[list[int]], positionen: PositionsBuckets | None,
+                     ziel: str | None, max_parallel: int, nur_partitionen: set[str] | None = None) -> BuildStand:
+    # Läuft im Worker-Prozess: nur die Record-Batches des eigenen Loses aus der gemappten IPC-Datei lesen
+    # ziel None -> nur Hashes/Aggregat berechnen, nichts schreiben
+    bloecke = auftrag_bloecke(pa.ipc.open_file(pa.memory_map(quelle_pfad)), batches_je_bucket, positionen)
+    if ziel is None:
+        return durchlaufe_quelle(bloecke)
+    schreiber = PartitionSchreiber(Path(ziel), max_parallel)
+    try:
+        stand = durchlaufe_quelle(bloecke, schreiber, nur_partitionen)
+    finally:
+        schreiber.schliessen()
+    return stand
+
+def verteile_partitionen(zeilen: dict[str, int], jobs: int) -> list[list[str]]:
+    # Größte Partition zuerst an den bisher am wenigsten belasteten Worker
+    lose, last = [[] for _ in range(jobs)], [0] * jobs
+    for key in sorted(zeilen, key=zeilen.get, reverse=True):
+        i = last.index(min(last))
+        lose[i].append(key)
+        last[i] += zeilen[key]
+    return [l for l in lose if l]
 
-    dump_groups("Gewerk_Name", ORDNER_GEWERK, gewerke)
-    dump_groups("Schadenart_Name", ORDNER_SCHADENSFALL, schadensarten)
-    dump_groups(["Schadenart_Name", "Falltyp_Name"], ORDNER_FALLTYP)
+def baue_parallel(quelle_pfad: Path, batch_lose: list[list[list[int]]], positionen: PositionsBuckets | None,
+                  ziel: Path | None, max_parallel: int, nur_partitionen: set[str] | None = None) -> BuildStand:
+    threads = max(1, max_parallel // max(1, len(batch_lose)))
+    args = (str(quelle_pfad), positionen, None if ziel is None else str(ziel), threads, nur_partitionen)
+    if len(batch_lose) <= 1:
+        staende = [baue_partitionen(args[0], nrn, *args[1:]) for nrn in batch_lose]
+    else:
+        with ProcessPoolExecutor(max_workers=len(batch_lose)) as pool:
+            staende = list(pool.map(baue_partitionen, repeat(args[0]), batch_lose, *(repeat(a) for a in args[1:])))
 
-    write_index(gewerke, schadensarten, falltypen_map)
+    falltypen_map = {}
+    for s in staende:
+        for schaden, falltypen in s.falltypen_map.items():
+            falltypen_map.setdefault(schaden, set()).update(falltypen)
+    return BuildStand(
+        {k: v for s in staende for k, v in s.hashes.items()},
+        _verdichte([s.aggregat for s in staende]),
+        set().union(*(s.gewerke for s in staende)),
+        falltypen_map,
+    )
+
+def generate_aggregat_file(aggregat: pd.DataFrame) -> None:
+    agg = (
+        aggregat.astype({c: "category" for c in AGGREGAT_SCHLUESSEL if c != "HW_ID"})
+        .merge(load_handwerker_dimension()[["HW_ID", "Handwerker_Name", "PLZ_HW", "Land"]], on="HW_ID", how="left")
+        .sort_values(["Schadenart_Name", "Falltyp_Name", "Gewerk_Name"], kind="stable")
+    )
+    tmp = AGGREGAT_FILE.with_name(AGGREGAT_FILE.name + ".tmp")
+    agg.to_parquet(tmp, index=False, row_group_size=ROW_GROUP_GROESSE)
+    os.replace(tmp, AGGREGAT_FILE)
+
+def generate_parquet_files(inkrementell: bool = False, jobs: int = 1, max_parallel: int = SCHREIB_THREADS) -> None:
+    manifest = load_manifest() if inkrementell and ORDNER_DATASET.exists() else {}
+    if manifest and (manifest.get("build_version"), manifest.get("bereinigung_version")) != (BUILD_VERSION, BEREINIGUNG_VERSION):
+        # Partition-Hashes sehen nur die Daten, nicht wie sie geschrieben werden -> alles neu aufbauen
+        print("Build- oder Bereinigungsversion geändert, vollständiger Neuaufbau.")
+        manifest = {}
+    fingerprint = quell_fingerprint()
+    if manifest and manifest.get("quelle") == fingerprint:
+        print("Quelldaten unverändert, nichts zu tun.")
+        return
+
+    if not bereinigt_aktuell():
+        build_Auftragsdaten_bereinigt()
+    # Vorab festlegen, was gebraucht wird: Dataset, Aggregat und Index kommen mit RELEVANTE_SPALTEN aus;
+    # ohne weitere Positionsdaten-Spalten bestimmen die Positionen nur, wie oft jede Auftragszeile vorkommt
+    quell_spalten = pq.read_schema(AUFTRAGSDATEN_BEREINIGT_PFAD).names
+    spalten = [c for c in POSITIONS_SPALTEN if c not in quell_spalten]
+    anzahl = None if spalten else positionen_je_rechnung()
+
+    # Partitionen vorab auf die Worker verteilen; jeder Worker liest später nur die Batches seines Loses
+    lose = verteile_partitionen(zaehle_partitionen(anzahl), jobs)
+    los_von = {key: i for i, los in enumerate(lose) for key in los}
+    # Gebaut wird in einem Nachbarordner, das live Dataset bleibt bis zum Tausch lesbar
+    neu = ORDNER_DATASET.with_name(ORDNER_DATASET.name + ".neu")
+    if neu.exists():
+        shutil.rmtree(neu)      # Rest eines abgebrochenen Builds
+    try:
+        # Mit Positions-Spalten: beide Seiten nach Hash-Bucket der KvaRechnung_ID aufteilen, damit je Bucket
+        # nur dessen Positionen im Speicher liegen und Positionsdaten genau einmal gelesen werden
+        typ = positions_id_typ() if spalten else None
+        positionen = stage_positionen(BUILD_POSITIONEN_FILE, spalten, typ) if spalten else None
+        batch_lose = stage_quelle(BUILD_QUELLE_FILE, anzahl, los_von, len(lose), positionen, typ)
+        if manifest:
+            # Erst nur Hashes berechnen, dann in einem zweiten Durchlauf gezielt die geänderten Partitionen schreiben
+            stand = baue_parallel(BUILD_QUELLE_FILE, batch_lose, positionen, None, max_parallel)
+            alt = manifest.get("partitionen", {})
+            geaendert = {k for k, v in stand.hashes.items() if alt.get(k) != v}
+            entfernt = set(alt) - set(stand.hashes)
+            # Unveränderte Partitionen per Hardlink übernehmen: keine Kopie, das live Dataset bleibt unberührt
+            shutil.copytree(ORDNER_DATASET, neu, copy_function=_verlinke)
+            loesche_partitionen(neu, entfernt | geaendert)
+            betroffen = [nrn for los, nrn in zip(lose, batch_lose) if geaendert.intersection(los)]
+            baue_parallel(BUILD_QUELLE_FILE, betroffen, positionen, neu, max_parallel, nur_partitionen=geaendert)
+            print(f"{len(geaendert)} Partitionen geändert, {len(entfernt)} entfernt.")
+        else:
+            neu.mkdir(parents=True)
+            stand = baue_parallel(BUILD_QUELLE_FILE, batch_lose, positionen, neu, max_parallel)
+        tausche_dataset(neu)
+    finally:
+        BUILD_QUELLE_FILE.unlink(missing_ok=True)
+        BUILD_POSITIONEN_FILE.unlink(missing_ok=True)
+        shutil.rmtree(neu, ignore_errors=True)   # nur nach einem Fehler noch vorhanden
+
+    # Index zuletzt: seine mtime lässt die Dashboards das Dataset neu einlesen
+    generate_aggregat_file(stand.aggregat)
+    write_index(stand.gewerke, stand.falltypen_map.keys(), stand.falltypen_map)
+    MANIFEST_FILE.write_text(json.dumps(
+        {"quelle": fingerprint, "build_version": BUILD_VERSION, "bereinigung_version": BEREINIGUNG_VERSION,
+         "partitionen": stand.hashes}, ensure_ascii=False, indent=2
+    ), "utf-8")
 
 INDEX = load_index()
 GEWERKE_LISTE = INDEX["gewerke"]
@@ -81,15 +548,47 @@ def list_schadensarten(): return SCHADENSARTEN_LISTE
 @st.cache_data
 def list_falltypen_for_schadensart(s: str): return FALLTYPEN_BY_SCHADENSART.get(s, [])
 
+@st.cache_resource
+def _dataset(stand: int) -> ds.Dataset:
+    # stand = mtime der Indexdatei -> nach jedem Build wird das Dataset neu eingelesen
+    return ds.dataset(ORDNER_DATASET, format="parquet", partitioning=PARTITIONIERUNG)
+
+def _filter_gewerk(gewerk: str) -> ds.Expression:
+    return ds.field("Gewerk_Name") == gewerk
+
+def _filter_schaden(schaden: str, falltyp: str | None) -> ds.Expression:
+    expr = ds.field("Schadenart_Name") == schaden
+    if falltyp and falltyp != "Alle":
+        expr = expr & (ds.field("Falltyp_Name") == falltyp)
+    return expr
+
+def _scan(filter_expr: ds.Expression) -> pd.DataFrame:
+    dataset = _dataset(INDEX_FILE.stat().st_mtime_ns)
+    cols = [c for c in RELEVANTE_SPALTEN if c in dataset.schema.names]
+    return dataset.to_table(columns=cols, filter=filter_expr).to_pandas()
+
 def lade_subset_auftragsdaten_gewerk(gewerk: str) -> pd.DataFrame:
-    return subset(pd.read_parquet(ORDNER_GEWERK / f"{make_safe(gewerk)}.parquet"))
+    return _scan(_filter_gewerk(gewerk))
 
 def lade_subset_auftragsdaten(schaden: str, falltyp: str | None = None) -> pd.DataFrame:
-    s = make_safe(schaden)
-    p = (ORDNER_SCHADENSFALL / f"{s}.parquet") if (not falltyp or falltyp == "Alle") \
-        else (ORDNER_FALLTYP / s / f"{make_safe(falltyp)}.parquet")
-    return subset(pd.read_parquet(p))
+    return _scan(_filter_schaden(schaden, falltyp))
+
+# Vorberechnete Summen je Handwerker/Filterkombination (siehe generate_aggregat_file)
+def _scan_aggregat(filter_expr: ds.Expression) -> pd.DataFrame:
+    return ds.dataset(AGGREGAT_FILE, format="parquet").to_table(filter=filter_expr).to_pandas()
+
+def lade_aggregat_gewerk(gewerk: str) -> pd.DataFrame:
+    return _scan_aggregat(_filter_gewerk(gewerk))
+
+def lade_aggregat(schaden: str, falltyp: str | None = None) -> pd.DataFrame:
+    return _scan_aggregat(_filter_schaden(schaden, falltyp))
 
 if __name__ == "__main__":
-    generate_parquet_files()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inkrementell", action="store_true",
+                        help="nur geänderte Schadenart/Falltyp-Partitionen neu schreiben")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Anzahl Worker-Prozesse, auf die die Partitionen verteilt werden")
+    args = parser.parse_args()
+    generate_parquet_files(inkrementell=args.inkrementell, jobs=max(1, args.jobs))
     print("Fertig.")
\ No newline at end of file
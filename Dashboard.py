@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 from urllib.parse import quote
 from GooglePlaces import load_cache, get_handwerker_data, CACHE_FILE_PATH
-from Preiszuverlässigkeit import berechne_zuverlaessigkeit
+from Preiszuverlaessigkeit import berechne_zuverlaessigkeit
 from Auftrags_und_Positionsdaten import (
     list_schadensarten, list_falltypen_for_schadensart, lade_subset_auftragsdaten,
     list_gewerke, lade_subset_auftragsdaten_gewerk,
@@ -1,39 +1,128 @@
 import streamlit as st
 import pandas as pd
-import sys
+import numpy as np
 from urllib.parse import quote
-from GooglePlaces import load_cache, get_handwerker_data, CACHE_FILE_PATH
-from Preiszuverlaessigkeit import berechne_zuverlaessigkeit
+from concurrent.futures import ThreadPoolExecutor
+from GooglePlaces_neu import (
+    load_cache, get_handwerker_data, verbleibendes_budget, cache_statistik, MAX_CALLS_PER_MONTH,
+    HintergrundAktualisierer,
+)
+from Preiszuverlaessigkeit import berechne_zuverlaessigkeit_aggregiert
+from data_loader import load_handwerker_dimension, handwerker_schluessel, DIM_SCHLUESSEL
 from Auftrags_und_Positionsdaten import (
-    list_schadensarten, list_falltypen_for_schadensart, lade_subset_auftragsdaten,
-    list_gewerke, lade_subset_auftragsdaten_gewerk,
+    list_schadensarten, list_falltypen_for_schadensart, lade_aggregat,
+    list_gewerke, lade_aggregat_gewerk,
 )
-from Postleitzahlentfernung import datensaetze_im_umkreis, get_geo_strukturen, nomi, ZFILL
+from Postleitzahlentfernung import datensaetze_im_umkreis, k_naechste_handwerker, get_geo_strukturen, geokodiere, ZFILL
 
 st.set_page_config(page_title="SOLERA Dashboard", layout="wide")
 
 SCORE_COLS = ["Entfernungsscore", "Preiszuverlässigkeitsscore"]
+REVIEW_WORKERS = 4   # parallele Google-Abfragen je Session
 
 if "geo_struct" not in st.session_state:
     with st.spinner("Lade Geo-Daten …"):
         st.session_state.geo_struct = get_geo_strukturen()
 
-auftrag_geo, plz_coords, tree = st.session_state.geo_struct
+auftrag_geo, plz_index, hw_index = st.session_state.geo_struct
 
 def norm_weights(w: dict) -> dict:
     s = sum(w.values()) or 0.0
     return {k: (v / s if s else 0.0) for k, v in w.items()}
 
-def pick_df(filter_mode, gewerk, schaden, falltyp):
+def review_index(df_cache: pd.DataFrame, dim: pd.DataFrame) -> pd.DataFrame:
+    # Einmal je Cache-Version: jüngster Eintrag je HW_ID mit vorformatiertem Bewertungstext.
+    # Einträge ohne gespeicherte hw_id (z.B. aus der Zeit vor der Dimension) über den normalisierten Schlüssel zuordnen
+    cache_all = df_cache[["hw_id", "name_original", "plz", "country", "rating", "user_ratings_total", "last_updated", "status"]]
+    schluessel = handwerker_schluessel(cache_all["name_original"], cache_all["plz"], cache_all["country"])
+    ids = schluessel.merge(dim[["HW_ID", *DIM_SCHLUESSEL]], on=DIM_SCHLUESSEL, how="left")["HW_ID"]
+    cache_all = cache_all.assign(HW_ID=cache_all["hw_id"].fillna(pd.Series(ids.to_numpy(), index=cache_all.index)))
+    cache_all = (
+        cache_all
+        .dropna(subset=["HW_ID"])
+        .astype({"HW_ID": "int32"})
+        .sort_values("last_updated")
+        .drop_duplicates(subset="HW_ID", keep="last")
+        .set_index("HW_ID")
+    )
+    cache_all["base"] = (
+        cache_all["rating"].map(str).astype(str) + " ("
+        + pd.to_numeric(cache_all["user_ratings_total"], errors="coerce").fillna(0).astype(int).astype(str) + ")"
+    )
+    return cache_all[["status", "base", "last_updated"]]
+
+def google_reviews_spalte(hw_ids: pd.Series, index: pd.DataFrame, cutoff: pd.Timestamp) -> np.ndarray:
+    treffer = index.reindex(hw_ids.to_numpy())
+    return np.select(
+        [
+            treffer["status"].isna().to_numpy(),
+            treffer["status"].eq("ZERO_RESULTS").to_numpy(),
+            treffer["status"].ne("OK").to_numpy(),
+            treffer["last_updated"].lt(cutoff).to_numpy(),
+        ],
+        [
+            "Noch nicht abgefragt",
+            "Kein Google-Eintrag",
+            "Fehler bei Abfrage",
+            "(" + treffer["base"] + ") - vor über 30 Tagen abgefragt",
+        ],
+        default=treffer["base"],
+    )
+
+@st.cache_resource
+def hintergrund_aktualisierer() -> HintergrundAktualisierer:
+    # Einer je Prozess, von allen Sessions geteilt
+    return HintergrundAktualisierer()
+
+@st.fragment(run_every=1.0)
+def review_fortschritt():
+    # Läuft jede Sekunde, solange Abfragen offen sind; fertige Ergebnisse per App-Rerun übernehmen
+    jobs = st.session_state.get("review_jobs", {})
+    if not jobs:
+        return
+    fertig = [k for k, f in jobs.items() if f.done()]
+    st.progress(len(fertig) / len(jobs), text=f"Google Reviews: {len(fertig)} von {len(jobs)} geladen …")
+    if len(fertig) == st.session_state.review_jobs_fertig:
+        return
+
+    for k in fertig:
+        try:
+            row = jobs[k].result()
+            # auch ein fehlgeschlagenes Neuladen, bei dem der alte OK-Eintrag stehen bleibt
+            if row.get("status") in ("ERROR", "QUOTA") or row.get("fehler_status") in ("ERROR", "QUOTA"):
+                st.session_state.last_google_error = row.get("error_message")
+        except Exception as e:
+            # WICHTIG: nicht schlucken, sonst sieht man nie Key/Budget-Probleme
+            st.session_state.last_google_error = str(e)
+    if len(fertig) == len(jobs):
+        st.session_state.review_jobs = {}
+        st.session_state.review_jobs_fertig = 0
+    else:
+        st.session_state.review_jobs_fertig = len(fertig)
+
+    # Ergebnisse stehen bereits in der SQLite-DB -> Session-Kopie neu lesen
+    st.session_state.google_cache = load_cache()
+    st.session_state.google_cache_version += 1
+    st.rerun(scope="app")
+
+def pick_agg(filter_mode, gewerk, schaden, falltyp):
     if filter_mode == "Gewerk":
-        return lade_subset_auftragsdaten_gewerk(gewerk) if gewerk else None
-    return lade_subset_auftragsdaten(schaden, falltyp) if schaden else None
+        return lade_aggregat_gewerk(gewerk) if gewerk else None
+    return lade_aggregat(schaden, falltyp) if schaden else None
 
 
 
 def main():
+    aktualisierer = hintergrund_aktualisierer()
     if "google_cache" not in st.session_state:
         st.session_state.google_cache = load_cache()
+        st.session_state.google_cache_version = 0
+        st.session_state.google_cache_generation = aktualisierer.generation
+    elif st.session_state.google_cache_generation != aktualisierer.generation:
+        # Im Hintergrund aktualisierte Einträge beim nächsten Rerun übernehmen
+        st.session_state.google_cache_generation = aktualisierer.generation
+        st.session_state.google_cache = load_cache()
+        st.session_state.google_cache_version += 1
     h1, h2 = st.columns([4,2], vertical_alignment="bottom")
     with h1:
         st.markdown("<div style='height:100%; display:flex; align-items:flex-end;'>"
@@ -118,15 +207,33 @@ def main():
             country = st.selectbox("Land", options=["DE", "AT", "CH"], index=0)
 
         use_umkreis = st.toggle("Umkreissuche aktiv", value=False)
-        radius_km = st.number_input(
-            "Radius (km)",
-            min_value=1.0,
-            max_value=500.0,
-            value=20.0,
-            step=5.0,
+        umkreis_modus = st.radio(
+            "Umkreismodus",
+            ["Radius", "k nächste"],
+            horizontal=True,
             disabled=not use_umkreis,
-            help="Wenn die Umkreissuche deaktiviert ist, wird nur nach Handwerkern mit der genauen PLZ gefiltert (Entfernungsscore = 100)."
+            help="„k nächste“ liefert die k nächstgelegenen Handwerker in einem Durchlauf, der Radius gilt dann als maximale Entfernung."
         )
+        r1, r2 = st.columns([1.0, 1.0], gap="medium")
+        with r1:
+            radius_km = st.number_input(
+                "Radius (km)" if umkreis_modus == "Radius" else "Max. Entfernung (km)",
+                min_value=1.0,
+                max_value=500.0,
+                value=20.0 if umkreis_modus == "Radius" else 500.0,
+                step=5.0,
+                disabled=not use_umkreis,
+                help="Wenn die Umkreissuche deaktiviert ist, wird nur nach Handwerkern mit der genauen PLZ gefiltert (Entfernungsscore = 100)."
+            )
+        with r2:
+            k_naechste = st.number_input(
+                "Anzahl Handwerker (k)",
+                min_value=1,
+                max_value=500,
+                value=20,
+                step=5,
+                disabled=not use_umkreis or umkreis_modus != "k nächste",
+            )
 
 
     with row1_mid:
@@ -214,13 +321,13 @@ def main():
             st.warning("Bitte gültige PLZ eingeben.")
             return
 
-        info = nomi(country).query_postal_code(plz_input)
-        if pd.isna(info.latitude) or pd.isna(info.longitude):
+        _, plz_index, _ = st.session_state.geo_struct
+        if geokodiere(plz_index, country, plz_input) is None:
             st.warning("Bitte gültige PLZ eingeben.")
             return
         
-        df_raw = pick_df(filter_mode, gewerk_input, schadensart_input, falltyp_input)
-        if df_raw is None:
+        df_agg = pick_agg(filter_mode, gewerk_input, schadensart_input, falltyp_input)
+        if df_agg is None:
             st.warning("Bitte zuerst einen gültigen Filter auswählen.")
             return
 
@@ -234,6 +341,8 @@ def main():
             "country": country,
             "use_umkreis": use_umkreis,
             "radius_km": radius_km,
+            "umkreis_modus": umkreis_modus,
+            "k_naechste": k_naechste,
             "w_raw": w_raw,   # optional: falls du später Gewichtung/Anzeige stabil halten willst
             "w": w,
         }
@@ -254,6 +363,8 @@ def main():
         country = ctx["country"]
         use_umkreis = ctx["use_umkreis"]
         radius_km = ctx["radius_km"]
+        umkreis_modus = ctx["umkreis_modus"]
+        k_naechste = ctx["k_naechste"]
         w_raw = ctx["w_raw"]
         w = ctx["w"]
 
@@ -262,32 +373,42 @@ def main():
     
     
 
-    df_raw = pick_df(filter_mode, gewerk_input, schadensart_input, falltyp_input)
-    if df_raw is None:
+    df_agg = pick_agg(filter_mode, gewerk_input, schadensart_input, falltyp_input)
+    if df_agg is None:
         st.warning("Bitte zuerst einen gültigen Filter auswählen.")
         return
 
     if do_search:
-        dashboard = df_raw[["Handwerker_Name", "PLZ_HW", "Land"]].drop_duplicates().reset_index(drop=True)
+        dashboard = df_agg[["HW_ID", "Handwerker_Name", "PLZ_HW", "Land"]].drop_duplicates("HW_ID").reset_index(drop=True)
         dashboard = dashboard.merge(
-            berechne_zuverlaessigkeit(df_raw)[["Handwerker_Name", "Preiszuverlässigkeitsscore"]],
-            on="Handwerker_Name", how="left")
+            berechne_zuverlaessigkeit_aggregiert(df_agg, schluessel="HW_ID")[["HW_ID", "Preiszuverlässigkeitsscore"]],
+            on="HW_ID", how="left")
     
         if use_umkreis:
             with st.spinner("Berechne Umkreis..."):
-                auftrag_geo, plz_coords, tree = st.session_state.geo_struct
-                relevante_hw = set(dashboard["Handwerker_Name"].unique())
-                auftrag_geo_sub = auftrag_geo[auftrag_geo["Handwerker_Name"].isin(relevante_hw)]
+                auftrag_geo, plz_index, hw_index = st.session_state.geo_struct
+                auftrag_geo_sub = auftrag_geo[auftrag_geo["HW_ID"].isin(dashboard["HW_ID"])]
                 
             try:
-                geo_result = datensaetze_im_umkreis(
-                plz_input,
-                radius_km,
-                country,
-                auftrag_geo_sub,
-                plz_coords,
-                tree,
-                )
+                if umkreis_modus == "k nächste":
+                    geo_result = k_naechste_handwerker(
+                    plz_input,
+                    k_naechste,
+                    country,
+                    auftrag_geo_sub,
+                    plz_index,
+                    hw_index,
+                    max_km=radius_km,
+                    )
+                else:
+                    geo_result = datensaetze_im_umkreis(
+                    plz_input,
+                    radius_km,
+                    country,
+                    auftrag_geo_sub,
+                    plz_index,
+                    hw_index,
+                    )
             except ValueError:
                 st.warning(f"Bitte gültige PLZ eingeben.")
                 st.stop()
@@ -296,8 +417,8 @@ def main():
                 st.warning("Keine Handwerker im gewünschten Umkreis gefunden.")
                 return
 
-            geo = geo_result[["Handwerker_Name", "Land", "PLZ_HW", "Entfernung in km", "Entfernungsscore"]]
-            dashboard = dashboard.merge(geo, on=["Handwerker_Name", "Land", "PLZ_HW"], how="inner")
+            geo = geo_result[["HW_ID", "Entfernung in km", "Entfernungsscore"]]
+            dashboard = dashboard.merge(geo, on="HW_ID", how="inner")
             dashboard[["Entfernung in km", "Entfernungsscore"]] = dashboard[["Entfernung in km", "Entfernungsscore"]].apply(pd.to_numeric, errors="coerce")
 
         else:
@@ -335,7 +456,8 @@ def main():
     filter_text = (f"**Filtermodus:** {filter_mode}"
                    + (f" · **Gewerk:** {gewerk_input}" if filter_mode == "Gewerk" else f" · **Schadenart:** {schadensart_input} · **Falltyp:** {ft}")
                    + f" · **PLZ:** {plz_input} · **Land:** {country}"
-                   + (f" · **Umkreis:** {radius_km:.0f} km" if use_umkreis else " · **Umkreis:** nein"))
+                   + ((f" · **Umkreis:** {k_naechste} nächste (max. {radius_km:.0f} km)" if umkreis_modus == "k nächste"
+                       else f" · **Umkreis:** {radius_km:.0f} km") if use_umkreis else " · **Umkreis:** nein"))
     
     st.markdown(filter_text)
        
@@ -352,92 +474,24 @@ def main():
     st.subheader("Handwerkervorschläge")
     
     # Google Reviews aus Cache vorbelegen
-    df_cache = st.session_state.google_cache
-
-    # WICHTIG: last_updated kommt aus CSV und kann String / NaT / Timestamp sein.
-    # Für Vergleiche MUSS die Spalte explizit in datetime konvertiert werden.
-    df_cache["last_updated"] = pd.to_datetime(
-        df_cache["last_updated"],
-        errors="coerce",
-        utc=True
-    )
-
-    cutoff = pd.Timestamp.utcnow() - pd.Timedelta(days=30)
-
-    n_total = len(df_cache)
-    n_expired = df_cache["last_updated"].lt(cutoff).sum()
-
-    print(f"[CACHE] geladen:{n_total} Einträge, davon abgelaufen: {n_expired}", file=sys.stderr)
-
-    def _norm_plz(plz_val, ctry):
-        s = str(plz_val).strip() if plz_val is not None else ""
-        target_len = ZFILL.get(str(ctry), len(s) if len(s) > 0 else 5)
-        return s.zfill(target_len)
-
-    cache_all = df_cache.copy()
-
-    cache_all["plz_norm"] = cache_all.apply(
-        lambda r: _norm_plz(r.get("plz"), r.get("country")),
-        axis=1
-    )
-
-    cache_all["key"] = (
-        cache_all["name_original"].astype(str).str.lower().str.strip() + "|" +
-        cache_all["plz_norm"] + "|" +
-        cache_all["country"].astype(str)
-    )
-
-    cache_all = (
-        cache_all
-        .sort_values("last_updated")
-        .drop_duplicates(subset="key", keep="last")
-    )
-
-    cache_map = cache_all.set_index("key")[["rating", "user_ratings_total", "last_updated", "status"]].to_dict("index")
-
-    dashboard["plz_norm"] = dashboard.apply(
-        lambda r: _norm_plz(r["PLZ_HW"], r["Land"]),
-        axis=1
-    )
-
-    dashboard["key"] = (
-        dashboard["Handwerker_Name"].astype(str).str.lower().str.strip() + "|" +
-        dashboard["plz_norm"] + "|" +
-        dashboard["Land"].astype(str)
-    )
-
-    print(
-        f"[DASHBOARD] key-Spalte erzeugt, Beispiel: {dashboard['key'].iloc[0] if len(dashboard) else '—'}",
-        file=sys.stderr
-    )
-
-    def fmt_review(row):
-        key = row["key"]
-
-        if key not in cache_map:
-            return "Noch nicht abgefragt"
-        
-        entry = cache_map[key]
-
-        if entry.get("status") != "OK":
-            return "Fehler bei Abfrage"
-        
-        rating = entry.get("rating")
-        total = entry.get("user_ratings_total")
-        last_updated = entry.get("last_updated")
-
-        base = f"{rating} ({int(total) if not pd.isna(total) else 0})"
-        
-        print(
-            f"[CACHE-CHECK] {key} last_updated={last_updated}", file = sys.stderr
-        )
-
-        if pd.notna(last_updated) and last_updated < cutoff:
-            return f"({base}) - vor über 30 Tagen abgefragt"
-        
-        return base
-
-    dashboard["Google Reviews"] = dashboard.apply(fmt_review, axis=1)
+    # Schlüsselindex nur neu bauen, wenn sich der Cache geändert hat (nicht bei jedem Rerun)
+    if st.session_state.get("review_index_version") != st.session_state.google_cache_version:
+        st.session_state.review_index = review_index(st.session_state.google_cache, load_handwerker_dimension())
+        st.session_state.review_index_version = st.session_state.google_cache_version
+
+    cutoff = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=30)
+    dashboard["Google Reviews"] = google_reviews_spalte(dashboard["HW_ID"], st.session_state.review_index, cutoff)
+    offen = [k for k, f in st.session_state.get("review_jobs", {}).items() if not f.done()]
+    dashboard.loc[dashboard["HW_ID"].isin(offen), "Google Reviews"] = "Wird geladen …"
+
+    # Veraltete Bewertungen sofort anzeigen und im Hintergrund neu laden lassen
+    # (je Suche nur einmal melden, damit Reruns die Häufigkeit nicht verfälschen)
+    if st.session_state.get("aktualisierung_gemeldet") is not st.session_state.search_ctx:
+        st.session_state.aktualisierung_gemeldet = st.session_state.search_ctx
+        treffer = st.session_state.review_index.reindex(dashboard["HW_ID"].to_numpy())
+        veraltet = (treffer["status"].eq("OK") & treffer["last_updated"].lt(cutoff)).to_numpy()
+        hw = list(dashboard[["Handwerker_Name", "PLZ_HW", "Land"]].astype(str).itertuples(index=False, name=None))
+        aktualisierer.vormerken(hw, [h for h, v in zip(hw, veraltet) if v])
 
     
     # Checkbox nur aktiv, wenn noch nicht abgefragt
@@ -479,7 +533,12 @@ def main():
         if not edited_rows:
             return
 
-        df_cache_local = st.session_state.google_cache
+        # Abfragen laufen im Executor der Session, der Callback kehrt sofort zurück
+        if "review_executor" not in st.session_state:
+            st.session_state.review_executor = ThreadPoolExecutor(max_workers=REVIEW_WORKERS, thread_name_prefix="reviews")
+            st.session_state.review_jobs = {}
+            st.session_state.review_jobs_fertig = 0
+        jobs = st.session_state.review_jobs
 
         # "edited_rows" ist ein dict: {row_index: {"Spaltenname": neuerWert, ...}, ...}
         # Wir reagieren nur auf Änderungen an der Checkbox-Spalte.
@@ -487,25 +546,23 @@ def main():
             if changes.get("Google Reviews laden") is True:
                 # Die Zeile aus der aktuell angezeigten Tabelle holen:
                 row = st.session_state.hw_table_df.iloc[int(row_idx)]
+                hw_id = int(st.session_state.hw_table_ids[int(row_idx)])
 
-                try:
-                    _, df_cache_local = get_handwerker_data(
+                if hw_id not in jobs or jobs[hw_id].done():
+                    jobs[hw_id] = st.session_state.review_executor.submit(
+                        get_handwerker_data,
                         name=row["Handwerker_Name"],
                         plz=row["PLZ_HW"],
                         country=row["Land"],
-                        df_cache=df_cache_local,
-                        force_api= True
+                        force_api= True,
+                        hw_id=hw_id,
                     )
-                except Exception as e:
-                    # WICHTIG: nicht schlucken, sonst sieht man nie Key/Budget-Probleme
-                    st.session_state.last_google_error = str(e)
-                finally:
-                    # Checkbox wieder aus (sonst löst jeder Rerun erneut aus)
-                    st.session_state.hw_table_df.at[int(row_idx), "Google Reviews laden"] = False
-
-        st.session_state.google_cache = df_cache_local
+                # Checkbox wieder aus (sonst löst jeder Rerun erneut aus)
+                st.session_state.hw_table_df.at[int(row_idx), "Google Reviews laden"] = False
 
     st.session_state.hw_table_df = dashboard[cols].copy()
+    # HW_ID wird nicht angezeigt, aber für den Callback zeilengleich mitgeführt
+    st.session_state.hw_table_ids = dashboard["HW_ID"].to_numpy()
 
     edited = st.data_editor(
         #dashboard[cols], 
@@ -519,6 +576,14 @@ def main():
         on_change=on_hw_table_change,
     )
     
+    st.caption(
+        f"Google-Abfragen diesen Monat noch verfügbar: {verbleibendes_budget()} von {MAX_CALLS_PER_MONTH}"
+        f" · durch Cache eingespart: {cache_statistik()['eingespart']}"
+        + (f" · {n} veraltete Bewertungen werden im Hintergrund aktualisiert" if (n := aktualisierer.wartend()) else "")
+    )
+
+    review_fortschritt()
+
     if "last_google_error" in st.session_state:
         st.error(f"Google Places Fehler: {st.session_state.last_google_error}")
         del st.session_state["last_google_error"]
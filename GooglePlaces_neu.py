@@ -4,13 +4,77 @@ import os
 import streamlit as st
 import requests
 import sys
+import sqlite3
+import threading
+import hashlib
+import time
+import random
+import argparse
+import heapq
+from collections import Counter
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from data_loader import handwerker_schluessel_einzeln
 
 
 # Konfiguration
 GOOGLE_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
 MAX_CALLS_PER_MONTH = 1000
-CACHE_FILE_PATH = os.path.join(os.path.dirname(__file__), "cache.csv")
-CACHE_TTL_DAYS = 30 
+CACHE_FILE_PATH = os.path.join(os.path.dirname(__file__), "cache.csv")   # nur noch für die einmalige Migration
+CACHE_DB_PATH = os.path.join(os.path.dirname(__file__), "cache.sqlite")
+CACHE_TTL_DAYS = 30                    # Bewertungen (rating, Anzahl)
+CACHE_TTL_STAMMDATEN_DAYS = 180        # Adresse, Telefon, Website, Öffnungszeiten, ...
+CACHE_TTL_PLACE_ID_DAYS = 365          # Auflösung Name -> place_id (Text Search)
+CACHE_TTL_KEINE_TREFFER_DAYS = 90      # Google kennt den Betrieb nicht -> lange merken
+CACHE_TTL_FEHLER_MINUTEN = 15          # vorübergehende Fehler (Netz, 5xx, ...)
+CACHE_RETRY_AFTER_QUOTA_MINUTEN = 60   # nach Quota-Fehlern erst danach wieder anfragen
+# Basis-URL überschreibbar, z.B. für einen lokalen Test-Server
+PLACES_BASE_URL = os.getenv("GOOGLE_PLACES_BASE_URL", "https://maps.googleapis.com/maps/api/place")
+BULK_MAX_PARALLEL = 8
+BULK_REQUESTS_PER_SECOND = 10.0
+HINTERGRUND_REQUESTS_PER_SECOND = 2.0
+HINTERGRUND_BUDGET_RESERVE = 200       # so viele Abfragen bleiben für manuelle Abfragen im Dashboard übrig
+HTTP_TIMEOUT = 10
+HTTP_MAX_VERSUCHE = 4           # 1 Versuch + 3 Wiederholungen
+HTTP_BACKOFF_BASIS = 0.5        # Sekunden, verdoppelt sich je Wiederholung
+HTTP_BACKOFF_MAX = 8.0
+
+CACHE_SPALTEN = [
+    "name_original","name", "plz", "country", "place_id",
+    "rating", "user_ratings_total",
+    "formatted_address", "website",
+    "formatted_phone_number", "international_phone_number", "opening_hours",
+    "types", "last_updated", "source",
+    "status", "error_message",
+    "place_id_updated", "bewertung_updated", "stammdaten_updated",
+    "hw_id",                            # ID aus der Handwerker-Dimension, falls beim Abfragen bekannt
+    "fehler_status", "fehler_updated",  # letzte fehlgeschlagene Aktualisierung eines OK-Eintrags
+]
+
+# Details-Felder je Gruppe; jede Gruppe hat ihren eigenen Zeitstempel "<gruppe>_updated" und ihre eigene TTL
+FELDGRUPPEN = {
+    "bewertung": ["rating", "user_ratings_total"],
+    "stammdaten": [
+        "name", "formatted_address", "formatted_phone_number", "international_phone_number",
+        "website", "opening_hours", "types",
+    ],
+}
+# Zeitstempel liegen als INTEGER (µs seit Epoche, UTC) in SQLite, load_cache liefert fertig typisierte Spalten
+ZEIT_SPALTEN = ["last_updated", "place_id_updated", "bewertung_updated", "stammdaten_updated", "fehler_updated"]
+CACHE_DTYPES = {
+    **{c: "string" for c in [
+        "name_original", "name", "plz", "place_id", "formatted_address", "website",
+        "formatted_phone_number", "international_phone_number", "opening_hours", "types", "error_message",
+    ]},
+    "country": "category",
+    "source": "category",
+    "status": "category",
+    "fehler_status": "category",
+    "rating": "float64",
+    "user_ratings_total": "Int64",
+    "hw_id": "Int32",
+}
 
 if not GOOGLE_API_KEY:
     raise RuntimeError(
@@ -19,62 +83,206 @@ if not GOOGLE_API_KEY:
     )
 
 print("GooglePlaces geladen aus:", __file__, file=sys.stderr)
-print("CACHE_FILE_PATH:", CACHE_FILE_PATH, file=sys.stderr)
+print("CACHE_DB_PATH:", CACHE_DB_PATH, file=sys.stderr)
 
-# Cache laden / speichern
-def load_cache():
-    if os.path.exists(CACHE_FILE_PATH):
-        df =  pd.read_csv(CACHE_FILE_PATH)
-
-        if "last_updated" in df.columns:
-            df["last_updated"] = pd.to_datetime(df.get("last_updated"), errors="coerce", utc = True)
-
-
-        # Normalisieren für zuverlässiges Matching
-        if "plz" in df.columns:
-            df["plz"] = df["plz"].astype(str)
-        if "name" in df.columns:
-            df["name"] = df["name"].astype(str)
-        if "country" in df.columns:
-            df["country"] = df["country"].astype(str)
-        if "name_original" in df.columns:
-            df["name_original"] = df["name_original"].astype(str)
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-        # # Cache auf 30 Tage begrenzen
-        # cutoff = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=CACHE_TTL_DAYS)
+# Cache (SQLite, WAL) – eine Zeile je normalisiertem (Name, PLZ, Land)
 
-        # # WICHTIG:
-        # # last_updated kommt aus CSV und kann String / NaT / Timestamp sein.
-        # # Für Vergleiche mit cutoff MUSS die Spalte explizit in datetime konvertiert werden.
-        # df["last_updated"] = pd.to_datetime(
-        #     df["last_updated"],
-        #     errors="coerce",
-        #     utc=True
-        # )
+_local = threading.local()
 
-        # if "last_updated" in df.columns:
-        #     df = df[df["last_updated"].isna() | (df["last_updated"] >= cutoff)].copy()
+def cache_key(name, plz, country) -> tuple[str, str, str]:
+    # gleiche Normalisierung wie die Handwerker-Dimension (data_loader.handwerker_schluessel),
+    # damit review_index im Dashboard Einträge ohne hw_id ihrer HW_ID zuordnen kann
+    return handwerker_schluessel_einzeln(name, plz, country)
 
+def _init_db(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS places_cache (
+            name_key TEXT NOT NULL,
+            plz_key TEXT NOT NULL,
+            country_key TEXT NOT NULL,
+            {", ".join(CACHE_SPALTEN)},
+            PRIMARY KEY (name_key, plz_key, country_key)
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_places_cache_source_updated ON places_cache (source, last_updated)")
+
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS quota_ledger (
+            monat TEXT NOT NULL,
+            key_hash TEXT NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (monat, key_hash)
+        )
+    """)
 
-        return df
+    # Migrationen einmalig ausführen (user_version merkt sich den Stand)
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # Übernahme aus cache.csv
+            if os.path.exists(CACHE_FILE_PATH):
+                df = pd.read_csv(CACHE_FILE_PATH, dtype={"plz": str})
+                df["last_updated"] = pd.to_datetime(df.get("last_updated"), errors="coerce", utc=True, format="ISO8601")
+                df = df.sort_values("last_updated", na_position="first")
+                rows = df.reindex(columns=CACHE_SPALTEN).to_dict("records")
+                _upsert(con, rows)
+                print(f"[CACHE] {len(rows)} Einträge aus {CACHE_FILE_PATH} übernommen", file=sys.stderr)
+        if version < 2:
+            # Ledger für den laufenden Monat mit dem bisherigen Zählstand aus dem Cache vorbelegen
+            # (last_updated kann hier noch ISO-Text aus älteren Versionen oder schon µs-Integer sein)
+            bisher = con.execute(
+                "SELECT COUNT(*) FROM places_cache WHERE source = 'google' AND "
+                "CASE typeof(last_updated) WHEN 'integer' THEN last_updated >= ? ELSE last_updated >= ? END",
+                (_zeit_db(_monatsanfang()), _monatsanfang().isoformat()),
+            ).fetchone()[0]
+            con.execute(
+                "INSERT INTO quota_ledger (monat, key_hash, calls) VALUES (?, ?, ?) "
+                "ON CONFLICT(monat, key_hash) DO UPDATE SET calls = MAX(calls, excluded.calls)",
+                (_monat(), _key_hash(), bisher),
+            )
+        if version < 3:
+            # Zeitstempel je Stufe/Feldgruppe nachrüsten; bestehende OK-Einträge gelten ab last_updated
+            vorhanden = {r[1] for r in con.execute("PRAGMA table_info(places_cache)")}
+            for spalte in ("place_id_updated", "bewertung_updated", "stammdaten_updated"):
+                if spalte not in vorhanden:
+                    con.execute(f"ALTER TABLE places_cache ADD COLUMN {spalte}")
+            con.execute(
+                "UPDATE places_cache SET place_id_updated = last_updated, bewertung_updated = last_updated, "
+                "stammdaten_updated = last_updated WHERE status = 'OK' AND place_id_updated IS NULL"
+            )
+        if version < 4:
+            # ISO-Text-Zeitstempel einmalig in µs-Integer umwandeln (danach kein Parsen mehr beim Laden)
+            vorhanden = {r[1] for r in con.execute("PRAGMA table_info(places_cache)")}
+            for spalte in (s for s in ZEIT_SPALTEN if s in vorhanden):
+                alt = con.execute(
+                    f"SELECT rowid, {spalte} FROM places_cache WHERE typeof({spalte}) = 'text'"
+                ).fetchall()
+                if alt:
+                    zeiten = pd.to_datetime(pd.Series([r[1] for r in alt]), errors="coerce", utc=True, format="ISO8601")
+                    con.executemany(
+                        f"UPDATE places_cache SET {spalte} = ? WHERE rowid = ?",
+                        [(_db_wert(z), r[0]) for z, r in zip(zeiten, alt)],
+                    )
+        if version < 5:
+            if "hw_id" not in {r[1] for r in con.execute("PRAGMA table_info(places_cache)")}:
+                con.execute("ALTER TABLE places_cache ADD COLUMN hw_id INTEGER")
+        if version < 6:
+            vorhanden = {r[1] for r in con.execute("PRAGMA table_info(places_cache)")}
+            for spalte in ("fehler_status", "fehler_updated"):
+                if spalte not in vorhanden:
+                    con.execute(f"ALTER TABLE places_cache ADD COLUMN {spalte}")
+        if version < 7:
+            # Schlüssel mit der gemeinsamen Normalisierung neu berechnen (Land groß, keine "00000"-PLZ mehr)
+            for r in con.execute(
+                "SELECT rowid, name_original, plz, country, name_key, plz_key, country_key FROM places_cache"
+            ).fetchall():
+                neu = cache_key(r[1], r[2], r[3])
+                if neu != tuple(r[4:7]):
+                    con.execute(
+                        "UPDATE OR REPLACE places_cache SET name_key = ?, plz_key = ?, country_key = ? WHERE rowid = ?",
+                        (*neu, r[0]),
+                    )
+        con.execute("PRAGMA user_version = 7")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+def _conn():
+    # Eine Verbindung je Thread (Streamlit-Sessions laufen in eigenen Threads)
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(CACHE_DB_PATH, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        _init_db(con)
+        _local.con = con
+    return con
+
+def _zeit_db(ts) -> int:
+    ts = pd.Timestamp(ts)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.value // 1000
+
+def _zeit(v):
+    # Gegenstück zu _zeit_db: µs-Integer aus der DB -> Timestamp (UTC), fehlend -> NaT
+    if v is None or v is pd.NaT:
+        return pd.NaT
+    if isinstance(v, pd.Timestamp):
+        return v
+    return pd.Timestamp(int(v), unit="us", tz="UTC")
+
+def _db_wert(v):
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return None
+    if isinstance(v, (pd.Timestamp, datetime)):
+        return _zeit_db(v)
+    if hasattr(v, "item"):
+        return v.item()
+    return v
+
+def _upsert(con, rows):
+    spalten = ["name_key", "plz_key", "country_key"] + CACHE_SPALTEN
+    # eine einmal bekannte hw_id bleibt erhalten, auch wenn ein späterer Aufruf sie nicht mitgibt
+    update = ", ".join(
+        f"{c}=COALESCE(excluded.{c}, {c})" if c == "hw_id" else f"{c}=excluded.{c}" for c in CACHE_SPALTEN
+    )
+    con.executemany(
+        f"INSERT INTO places_cache ({', '.join(spalten)}) VALUES ({', '.join('?' * len(spalten))}) "
+        f"ON CONFLICT(name_key, plz_key, country_key) DO UPDATE SET {update}",
+        [
+            (*cache_key(r.get("name_original"), r.get("plz"), r.get("country")),
+             *(_db_wert(r.get(c)) for c in CACHE_SPALTEN))
+            for r in rows
+        ],
+    )
 
-    return pd.DataFrame(columns=[
-        "name_original","name", "plz", "country", "place_id",
-        "rating", "user_ratings_total",
-        "formatted_address", "website",
-        "formatted_phone_number", "opening_hours",
-        "types", "last_updated", "source",
-        "status", "error_message"
-    ])
+def speichere_eintraege(rows) -> None:
+    # Alle Zeilen in einer Transaktion schreiben (Upsert, keine Datei-Neuschreibung)
+    con = _conn()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        _upsert(con, rows)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+def cache_eintrag(name, plz, country) -> dict | None:
+    row = _conn().execute(
+        "SELECT * FROM places_cache WHERE name_key=? AND plz_key=? AND country_key=?",
+        cache_key(name, plz, country),
+    ).fetchone()
+    if row is None:
+        return None
+    eintrag = {c: row[c] for c in CACHE_SPALTEN}
+    for spalte in ZEIT_SPALTEN:
+        eintrag[spalte] = _zeit(eintrag[spalte])
+    return eintrag
+
+def load_cache() -> pd.DataFrame:
+    # Einmal typisiert laden: Strings als string, Land/Status als category, Zeitstempel als datetime (UTC)
+    df = pd.read_sql_query(f"SELECT {', '.join(CACHE_SPALTEN)} FROM places_cache", _conn())
+    for spalte in ZEIT_SPALTEN:
+        df[spalte] = pd.to_datetime(df[spalte].astype("Int64"), unit="us", utc=True)
+    return df.astype(CACHE_DTYPES)
 
-def save_cache(df_cache):
-    df_cache.to_csv(CACHE_FILE_PATH, index=False)
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+# Zentrale Google-Antwortprüfung
 
+class KeineTrefferError(ValueError):
+    """Google kennt zu der Anfrage keinen Eintrag (ZERO_RESULTS)."""
 
-#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+class QuotaError(RuntimeError):
+    """Google- oder eigenes Monatslimit erreicht; erst nach retry-after erneut versuchen."""
 
-# Zentrale Google-Antwortprüfung
+class PlaceIdUngueltigError(RuntimeError):
+    """Gespeicherte place_id ist bei Google nicht (mehr) bekannt -> neu auflösen."""
 
 def check_google_status(response_json):
     status = response_json.get("status")
@@ -83,7 +291,7 @@ def check_google_status(response_json):
         return
 
     if status == "OVER_QUERY_LIMIT":
-        raise RuntimeError(
+        raise QuotaError(
             "Google Places API Quota überschritten. "
             "Weitere Abfragen wurden gestoppt."
         )
@@ -94,45 +302,258 @@ def check_google_status(response_json):
         )
 
     if status == "ZERO_RESULTS":
-        raise ValueError("Kein Google-Eintrag gefunden.")
+        raise KeineTrefferError("Kein Google-Eintrag gefunden.")
+
+    if status == "NOT_FOUND":
+        raise PlaceIdUngueltigError("place_id nicht mehr gültig.")
 
     raise RuntimeError(f"Unbekannter Google API Fehler: {status}")
 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-# Monatliches Abfragen Limit im Code erzwingen
+# Cache-Policy: wie lange ein Eintrag je Status gilt (bis dahin keine neue API-Abfrage)
+
+@dataclass(frozen=True)
+class CachePolicy:
+    ttl_bewertung: pd.Timedelta = pd.Timedelta(days=CACHE_TTL_DAYS)
+    ttl_stammdaten: pd.Timedelta = pd.Timedelta(days=CACHE_TTL_STAMMDATEN_DAYS)
+    ttl_place_id: pd.Timedelta = pd.Timedelta(days=CACHE_TTL_PLACE_ID_DAYS)
+    ttl_keine_treffer: pd.Timedelta = pd.Timedelta(days=CACHE_TTL_KEINE_TREFFER_DAYS)
+    ttl_fehler: pd.Timedelta = pd.Timedelta(minutes=CACHE_TTL_FEHLER_MINUTEN)
+    retry_after_quota: pd.Timedelta = pd.Timedelta(minutes=CACHE_RETRY_AFTER_QUOTA_MINUTEN)
+
+    def ttl(self, status) -> pd.Timedelta:
+        return {
+            "OK": self.ttl_bewertung,
+            "ZERO_RESULTS": self.ttl_keine_treffer,
+            "QUOTA": self.retry_after_quota,
+        }.get(status, self.ttl_fehler)
+
+    def _abgelaufen(self, zeitpunkt, ttl) -> bool:
+        zeitpunkt = _zeit(zeitpunkt)
+        return pd.isna(zeitpunkt) or zeitpunkt < pd.Timestamp.now(tz="UTC") - ttl
+
+    def faellig(self, cached, force_api: bool = False) -> tuple[bool, list[str]]:
+        # (place_id neu auflösen?, abgelaufene Feldgruppen) – force_api erneuert alle Gruppen,
+        # eine bekannte place_id bleibt aber bis zu ihrer eigenen TTL gültig
+        if cached is None:
+            return True, list(FELDGRUPPEN)
+        place_id_neu = not cached.get("place_id") or self._abgelaufen(cached.get("place_id_updated"), self.ttl_place_id)
+        if place_id_neu or cached["status"] != "OK" or force_api:
+            return place_id_neu, list(FELDGRUPPEN)
+        ttl = {"bewertung": self.ttl_bewertung, "stammdaten": self.ttl_stammdaten}
+        return False, [g for g in FELDGRUPPEN if self._abgelaufen(cached.get(f"{g}_updated"), ttl[g])]
+
+    def wartet_nach_fehler(self, cached) -> bool:
+        # Letzte Aktualisierung eines OK-Eintrags schlug fehl -> bis zum Ablauf der Fehler-TTL nicht erneut versuchen
+        status = cached.get("fehler_status")
+        return pd.notna(status) and not self._abgelaufen(cached.get("fehler_updated"), self.ttl(status))
+
+    def abfrage_noetig(self, cached, force_api: bool = False) -> bool:
+        # True, sobald die place_id neu aufgelöst oder mindestens eine Feldgruppe erneuert werden muss
+        place_id_neu, gruppen = self.faellig(cached, force_api)
+        return place_id_neu or bool(gruppen)
+
+    def gueltig(self, cached, force_api: bool = False) -> bool:
+        # force_api erneuert nur erfolgreiche Einträge; negative Ergebnisse und
+        # Quota-Sperren gelten trotzdem bis zum Ablauf ihrer TTL
+        if cached is None:
+            return False
+        if cached["status"] == "OK":
+            return self.wartet_nach_fehler(cached) or not self.abfrage_noetig(cached, force_api)
+        last_updated = _zeit(cached["last_updated"])
+        return pd.notna(last_updated) and last_updated >= pd.Timestamp.now(tz="UTC") - self.ttl(cached["status"])
+
+CACHE_POLICY = CachePolicy()
+
+def status_aus_fehler(e: Exception) -> str:
+    if isinstance(e, KeineTrefferError):
+        return "ZERO_RESULTS"
+    if isinstance(e, QuotaError):
+        return "QUOTA"
+    return "ERROR"
+
+# Zähler, wie viele API-Abfragen der Cache gespart hat (je Prozess)
+_statistik_lock = threading.Lock()
+_statistik = {"api_abfragen": 0, "cache_OK": 0, "cache_ZERO_RESULTS": 0, "cache_ERROR": 0, "cache_QUOTA": 0}
+
+def _zaehle(feld: str) -> None:
+    with _statistik_lock:
+        _statistik[feld] = _statistik.get(feld, 0) + 1
+
+def cache_statistik() -> dict:
+    with _statistik_lock:
+        stat = dict(_statistik)
+    stat["eingespart"] = sum(v for k, v in stat.items() if k.startswith("cache_"))
+    return stat
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# Monatliches Abfragen Limit im Code erzwingen (Ledger je Monat und API-Key, prozessübergreifend atomar)
+
+def _monatsanfang() -> pd.Timestamp:
+    return pd.Timestamp.now(tz="UTC").replace(day=1, hour=0, minute=0, second=0, microsecond=0, nanosecond=0)
+
+def _monat() -> str:
+    return _monatsanfang().strftime("%Y-%m")
+
+def _key_hash() -> str:
+    # Nur ein Hash des Keys landet in der Datenbank
+    return hashlib.sha256(GOOGLE_API_KEY.encode()).hexdigest()[:16]
 
-def google_calls_this_month(df_cache):
-    now = pd.Timestamp.now(tz="UTC")
-    month_start = now.replace(day=1, hour=0, minute=0, second=0)
-    df_cache["last_updated"] = pd.to_datetime(df_cache["last_updated"], errors="coerce", utc = True)
-    return len(df_cache[
-        (df_cache["source"] == "google") &
-        (pd.to_datetime(df_cache["last_updated"]) >= month_start)
-    ])
+def google_calls_this_month():
+    row = _conn().execute(
+        "SELECT calls FROM quota_ledger WHERE monat = ? AND key_hash = ?", (_monat(), _key_hash())
+    ).fetchone()
+    return row[0] if row is not None else 0
 
-def check_google_limit(df_cache):
-    if google_calls_this_month(df_cache) >= MAX_CALLS_PER_MONTH:
+def verbleibendes_budget() -> int:
+    return max(0, MAX_CALLS_PER_MONTH - google_calls_this_month())
+
+def reserviere_google_call() -> bool:
+    # Prüfen und Hochzählen in einem Statement: nur erfolgreich, solange das Limit nicht erreicht ist
+    con = _conn()
+    monat, key_hash = _monat(), _key_hash()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute(
+            "INSERT INTO quota_ledger (monat, key_hash, calls) VALUES (?, ?, 0) ON CONFLICT DO NOTHING",
+            (monat, key_hash),
+        )
+        ok = con.execute(
+            "UPDATE quota_ledger SET calls = calls + 1 WHERE monat = ? AND key_hash = ? AND calls < ?",
+            (monat, key_hash, MAX_CALLS_PER_MONTH),
+        ).rowcount == 1
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return ok
+
+def check_google_limit():
+    if google_calls_this_month() >= MAX_CALLS_PER_MONTH:
         raise RuntimeError(
             "Monatliches Google-API-Limit erreicht (1000)."
         )
 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+# HTTP-Client: ein Keep-Alive-Pool für alle Places-Aufrufe, Retry mit Backoff + Jitter, Zeitmessung
+
+class PlacesClient:
+    """Gemeinsamer HTTP-Zugang zur Places API.
+
+    `transport` ist alles mit `get(url, params=..., timeout=...)`, standardmäßig eine
+    requests.Session mit Connection-Pool; für Tests lässt sich ein eigener Transport
+    oder über `base_url` ein lokaler Fake-Server einsetzen. `reservieren` verbucht jeden
+    einzelnen HTTP-Versuch (auch Wiederholungen) im Monats-Ledger, bevor er rausgeht.
+    """
+
+    RETRY_HTTP_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str = PLACES_BASE_URL, transport=None,
+                 max_versuche: int = HTTP_MAX_VERSUCHE, backoff_basis: float = HTTP_BACKOFF_BASIS,
+                 backoff_max: float = HTTP_BACKOFF_MAX, timeout: float = HTTP_TIMEOUT,
+                 sleep=time.sleep, reservieren=reserviere_google_call):
+        if transport is None:
+            transport = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(BULK_MAX_PARALLEL, 10))
+            transport.mount("https://", adapter)
+            transport.mount("http://", adapter)
+        self.base_url = base_url.rstrip("/")
+        self.transport = transport
+        self.max_versuche = max(1, max_versuche)
+        self.backoff_basis = backoff_basis
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.sleep = sleep
+        self.reservieren = reservieren
+        self._lock = threading.Lock()
+        self._metriken = {}
+
+    def _wartezeit(self, versuch: int) -> float:
+        # "Full Jitter": zufällig zwischen 0 und dem exponentiellen Deckel
+        return random.uniform(0, min(self.backoff_max, self.backoff_basis * 2 ** versuch))
+
+    def _messen(self, endpunkt: str, dauer: float, wiederholungen: int, fehler: bool) -> None:
+        with self._lock:
+            m = self._metriken.setdefault(
+                endpunkt, {"aufrufe": 0, "wiederholungen": 0, "fehler": 0, "sekunden": 0.0, "max_sekunden": 0.0}
+            )
+            m["aufrufe"] += 1
+            m["wiederholungen"] += wiederholungen
+            m["fehler"] += int(fehler)
+            m["sekunden"] += dauer
+            m["max_sekunden"] = max(m["max_sekunden"], dauer)
+
+    def metriken(self) -> dict:
+        # Kopie je Endpunkt inkl. mittlerer Dauer
+        with self._lock:
+            return {
+                endpunkt: {**m, "mittel_sekunden": m["sekunden"] / m["aufrufe"] if m["aufrufe"] else 0.0}
+                for endpunkt, m in self._metriken.items()
+            }
+
+    def get_json(self, endpunkt: str, params: dict, warten=None) -> dict:
+        # warten (z.B. TokenBucket.acquire) läuft vor jedem HTTP-Versuch, also auch vor Wiederholungen
+        url = f"{self.base_url}/{endpunkt}/json"
+        start = time.perf_counter()
+        versuch = 0
+        fehler = True
+        try:
+            while True:
+                letzter = versuch + 1 >= self.max_versuche
+                if warten is not None:
+                    warten()
+                if not self.reservieren():
+                    raise QuotaError("Monatliches Google-API-Limit erreicht")
+                try:
+                    response = self.transport.get(url, params=params, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout):
+                    if letzter:
+                        raise
+                else:
+                    if response.status_code not in self.RETRY_HTTP_STATUS or letzter:
+                        response.raise_for_status()
+                        data = response.json()
+                        # OVER_QUERY_LIMIT ist oft nur ein kurzzeitiges Drosseln -> erneut versuchen
+                        if data.get("status") != "OVER_QUERY_LIMIT" or letzter:
+                            fehler = False
+                            return data
+                self.sleep(self._wartezeit(versuch))
+                versuch += 1
+        finally:
+            self._messen(endpunkt, time.perf_counter() - start, versuch, fehler)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> PlacesClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PlacesClient()
+        return _client
+
+def set_client(client: PlacesClient | None) -> None:
+    # z.B. für Tests einen Client mit eigenem Transport / Fake-Server setzen; None -> Standard
+    global _client
+    with _client_lock:
+        _client = client
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+
 # Google Places: Text Search (Place finden)
 
-def text_search_place(name, plz, country):
+def text_search_place(name, plz, country, warten=None):
     query = f"{name} {plz} {country}"
 
-    response = requests.get(
-        "https://maps.googleapis.com/maps/api/place/textsearch/json",
-        params={"query": query, "key": GOOGLE_API_KEY},
-        timeout=10
+    data = get_client().get_json(
+        "textsearch",
+        {"query": query, "key": GOOGLE_API_KEY},
+        warten,
     )
 
-    response.raise_for_status()
-    data = response.json()
-
     check_google_status(data)
 
     return data["results"][0]["place_id"]
@@ -143,32 +564,19 @@ def text_search_place(name, plz, country):
 
 # Place Details 
 
-def place_details(place_id):
-    response = requests.get(
-        "https://maps.googleapis.com/maps/api/place/details/json",
-        params={
+def place_details(place_id, gruppen=tuple(FELDGRUPPEN), warten=None):
+    # Nur die Felder der angefragten Gruppen anfordern (und zurückgeben)
+    felder = [f for g in gruppen for f in FELDGRUPPEN[g]]
+    data = get_client().get_json(
+        "details",
+        {
             "place_id": place_id,
-            "fields": (
-                "rating,"
-                "user_ratings_total,"
-                "formatted_address,"
-                "website,"
-                "formatted_phone_number,"
-                "name,"
-                "formatted_address,"
-                "formatted_phone_number,"
-                "opening_hours,"               # gibt ein Dict mit 'weekday_text'
-                "website,"
-                "types"  
-            ),
+            "fields": ",".join(felder),   # opening_hours liefert ein Dict mit 'weekday_text'
             "key": GOOGLE_API_KEY
         },
-        timeout=10
+        warten,
     )
 
-    response.raise_for_status()
-    data = response.json()
-
     check_google_status(data)
 
     result = data["result"]
@@ -177,7 +585,7 @@ def place_details(place_id):
     if "opening_hours" in result and "weekday_text" in result["opening_hours"]:
         opening_hours = "\n".join(result["opening_hours"]["weekday_text"])
 
-    return {
+    details = {
         "name": result.get("name"),
         "formatted_address": result.get("formatted_address"),
         "formatted_phone_number": result.get("formatted_phone_number"),
@@ -188,134 +596,247 @@ def place_details(place_id):
         "user_ratings_total": result.get("user_ratings_total"),
         "opening_hours": opening_hours 
     }
+    return {f: details[f] for f in felder}
 
 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # Zentrale Abfragen- Funktion (cache -> API)
 
-def get_handwerker_data(name, plz, country, df_cache, force_api: bool = False):
+def _ok_row(name, plz, country, place_id, details, cached=None, place_id_neu=True):
+    # Nur die frisch abgefragten Feldgruppen ersetzen, der Rest bleibt aus dem Cache
+    jetzt = pd.Timestamp.now(tz="UTC")
+    basis = cached if cached is not None and cached["status"] == "OK" and not place_id_neu else {}
+    row = {c: basis.get(c) for c in CACHE_SPALTEN}
+    row.update(details)
+    for gruppe, felder in FELDGRUPPEN.items():
+        if any(f in details for f in felder):
+            row[f"{gruppe}_updated"] = jetzt
+    row.update({
+        "name_original": name,
+        "plz": plz,
+        "country": country,
+        "place_id": place_id,
+        "place_id_updated": jetzt if place_id_neu else (cached or {}).get("place_id_updated"),
+        "last_updated": jetzt,
+        "source": "google",
+        "status": "OK",
+        "error_message": "",
+        "fehler_status": None,
+        "fehler_updated": None,
+    })
+    return row
+
+def _error_row(name, plz, country, e, status="ERROR", cached=None):
+    # Eine bekannte place_id überlebt Fehler, damit der nächste Versuch nur Details braucht
+    place_id_behalten = cached is not None and cached.get("place_id") and not isinstance(e, PlaceIdUngueltigError)
+    row = {c: None for c in CACHE_SPALTEN}
+    row.update({
+        "name_original": name,
+        "plz": plz,
+        "country": country,
+        "place_id": cached["place_id"] if place_id_behalten else None,
+        "place_id_updated": cached.get("place_id_updated") if place_id_behalten else None,
+        "last_updated": pd.Timestamp.now(tz="UTC"),
+        "source": "google",
+        "status": status,
+        "error_message": str(e),
+    })
+    return row
+
+def _fehler_row(name, plz, country, e, cached=None):
+    # Vorübergehende Fehler (Netz, 5xx, Quota) verdrängen keinen gültigen OK-Eintrag: Bewertung und Stammdaten
+    # bleiben stehen, vermerkt wird nur der Fehler (CachePolicy wartet dann bis zum nächsten Versuch)
+    status = status_aus_fehler(e)
+    if cached is not None and cached["status"] == "OK" and status != "ZERO_RESULTS":
+        return {**cached, "fehler_status": status, "fehler_updated": pd.Timestamp.now(tz="UTC"), "error_message": str(e)}
+    return _error_row(name, plz, country, e, status, cached)
+
+def _api_abfrage(name, plz, country, cached, policy: CachePolicy, force_api: bool, warten=None):
+    # Stufe 1: place_id nur auflösen, wenn unbekannt/abgelaufen; Stufe 2: nur abgelaufene Feldgruppen
+    # warten reicht bis in den Client durch und läuft dort vor jedem HTTP-Versuch
+    place_id_neu, gruppen = policy.faellig(cached, force_api)
+    if not place_id_neu:
+        try:
+            return _ok_row(name, plz, country, cached["place_id"],
+                           place_details(cached["place_id"], gruppen, warten), cached, place_id_neu=False)
+        except PlaceIdUngueltigError:
+            pass   # Betrieb umgezogen/geschlossen -> neu suchen, alle Felder laden
+    place_id = text_search_place(name, plz, country, warten)
+    return _ok_row(name, plz, country, place_id, place_details(place_id, warten=warten))
+
+def get_handwerker_data(name, plz, country, force_api: bool = False, policy: CachePolicy = CACHE_POLICY, hw_id=None,
+                        warten=None):
     print("get_handwerker_data() called with:", name, plz, country,"force_api=", force_api, file=sys.stderr)
 
     plz = str(plz)
     name = str(name)
     country = str(country)
 
-    # WICHTIG:
-    # df_cache kann aus CSV / Session / Concat stammen und enthält evtl. Strings.
-    # Vor jedem Datetime-Vergleich MUSS last_updated sauber typisiert werden.
-    df_cache["last_updated"] = pd.to_datetime(
-        df_cache.get("last_updated"),
-        errors="coerce",
-        utc=True
-    )
-
-
-    cutoff = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days = CACHE_TTL_DAYS)
-    
-    # Prüfen ob im Cache schon ein erfolgreicher Eintrag existiert
-    cached = df_cache[
-        (df_cache["name_original"].str.lower().str.strip() == name.lower().strip()) &
-        (df_cache["plz"] == plz) &
-        (df_cache["country"] == country) &
-        (df_cache["status"] == "OK")&
-        (df_cache["last_updated"].isna() | (df_cache["last_updated"] >= cutoff))
-    ]
+    # Prüfen ob im Cache ein noch gültiger Eintrag existiert (auch "kein Treffer" / Fehler mit TTL)
+    cached = cache_eintrag(name, plz, country)
 
-    if (not force_api) and (not cached.empty):
-        row = cached.iloc[0].to_dict()
-        row["source"] = "cache"
-        return row, df_cache
+    if policy.gueltig(cached, force_api):
+        _zaehle(f"cache_{cached['status']}")
+        cached["source"] = "cache"
+        return cached
 
-
-    # if not cached.empty:
-    #     row = cached.iloc[0].to_dict()
-    #     row["source"] = "cache"
-    #     return row, df_cache
-
-    # Google API Abfrage
+    # Google API Abfrage (jeder HTTP-Versuch wird im Client gegen das Monatslimit verbucht)
     try:
-        # Limit prüfen
-        if google_calls_this_month(df_cache) >= MAX_CALLS_PER_MONTH:
-            raise RuntimeError("Monatliches Google-API-Limit erreicht")
-
-        # Place ID suchen
-        place_id = text_search_place(name, plz, country)
-        details = place_details(place_id)
-
-        # Alten Eintrag, falls vorhanden löschen
-        df_cache = df_cache[
-        ~(
-            (df_cache["name_original"].str.lower().str.strip() == name.lower().strip()) &
-            (df_cache["plz"] == plz) &
-            (df_cache["country"] == country)
-        )
-    ]
-
-        # neues Ergebnis als Dataframe hinzufügen
-        new_row = {
-            "name_original": name,
-            "name" : details.get("name"),
-            "plz": plz,
-            "country": country,
-            "place_id": place_id,
-            **details,
-            "last_updated": pd.Timestamp.now(tz="UTC"),
-            "source": "google",
-            "status": "OK",
-            "error_message": ""
-        }
+        _zaehle("api_abfragen")
+        new_row = _api_abfrage(name, plz, country, cached, policy, force_api, warten)
+        new_row["hw_id"] = hw_id
 
-        df_cache = pd.concat([df_cache, pd.DataFrame([new_row])], ignore_index=True)
-        save_cache(df_cache)
+        # neues Ergebnis (ersetzt einen evtl. vorhandenen Eintrag per Upsert)
+        speichere_eintraege([new_row])
 
-        return new_row, df_cache
+        return new_row
 
     except Exception as e:
         print("GOOGLE ERROR for:", name, plz, country, file=sys.stderr)
         print("ERROR MESSAGE:", repr(e), file=sys.stderr)
-        # Fehler werden nicht im Cache gespeichert
-        error_row = {
-            "name_original": name,
-            "name": None,
-            "plz": plz,
-            "country": country,
-            "place_id": None,
-            "rating": None,
-            "user_ratings_total": None,
-            "formatted_address": None,
-            "website": None,
-            "formatted_phone_number": None,
-            "opening_hours": None,
-            "types": None,
-            "last_updated": pd.Timestamp.now(tz="UTC"),
-            "source": "google",
-            "status": "ERROR",
-            "error_message": str(e),
-        }
-
-        df_cache = df_cache[
-            ~(
-                (df_cache["name_original"].str.lower().str.strip() == name.lower().strip()) &
-                (df_cache["plz"] == plz) &
-                (df_cache["country"] == country)
-            )
-        ]
+        error_row = _fehler_row(name, plz, country, e, cached)
+        error_row["hw_id"] = hw_id
+        speichere_eintraege([error_row])
 
-        df_cache = pd.concat(
-            [df_cache, pd.DataFrame([error_row])],
-            ignore_index=True
-        )
+        if error_row["status"] == "OK":
+            # alter Eintrag bleibt gültig und wird wie ein Cache-Treffer geliefert
+            return {**error_row, "source": "cache"}
+        return error_row
 
-        save_cache(df_cache)
-
-        return error_row, df_cache
-
-    
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-    
+# Bulk-Anreicherung: viele Handwerker parallel, mit Rate-Limit und Monatsbudget
+
+class TokenBucket:
+    """Thread-sicherer Token-Bucket: höchstens `rate` Anfragen pro Sekunde (Burst bis `kapazitaet`)."""
+
+    def __init__(self, rate: float, kapazitaet: float | None = None):
+        self.rate = rate
+        self.kapazitaet = kapazitaet if kapazitaet is not None else max(1.0, rate)
+        self.tokens = self.kapazitaet
+        self.zeit = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                jetzt = time.monotonic()
+                self.tokens = min(self.kapazitaet, self.tokens + (jetzt - self.zeit) * self.rate)
+                self.zeit = jetzt
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                warten = (1 - self.tokens) / self.rate
+            time.sleep(warten)
+
+def lade_handwerker_bulk(handwerker: pd.DataFrame, force_api: bool = False,
+                         max_parallel: int = BULK_MAX_PARALLEL,
+                         requests_per_second: float = BULK_REQUESTS_PER_SECOND,
+                         policy: CachePolicy = CACHE_POLICY) -> pd.DataFrame:
+    # handwerker: Spalten Handwerker_Name, PLZ_HW, Land (z.B. Dashboard-Ergebnis oder auftrag_geo),
+    # optional HW_ID -> wird mit in den Cache geschrieben
+    eindeutig = handwerker[["Handwerker_Name", "PLZ_HW", "Land"]].astype(str)
+    eindeutig["hw_id"] = handwerker["HW_ID"].astype(object) if "HW_ID" in handwerker else None
+    eindeutig = eindeutig.drop_duplicates(["Handwerker_Name", "PLZ_HW", "Land"])
+    offen = []
+    for name, plz, country, hw_id in eindeutig.itertuples(index=False):
+        cached = cache_eintrag(name, plz, country)
+        if policy.gueltig(cached, force_api):
+            _zaehle(f"cache_{cached['status']}")
+        else:
+            offen.append((name, plz, country, cached, hw_id))
+    if not offen:
+        return pd.DataFrame(columns=CACHE_SPALTEN)
+
+    bucket = TokenBucket(requests_per_second)
+
+    def abfrage(name, plz, country, cached, hw_id):
+        # Das Budget verbucht der Client je HTTP-Versuch; ist es aufgebraucht, wird daraus ein QUOTA-Eintrag
+        try:
+            _zaehle("api_abfragen")
+            row = _api_abfrage(name, plz, country, cached, policy, force_api, warten=bucket.acquire)
+        except Exception as e:
+            row = _fehler_row(name, plz, country, e, cached)
+        row["hw_id"] = None if pd.isna(hw_id) else int(hw_id)
+        return row
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        rows = list(pool.map(lambda args: abfrage(*args), offen))
+
+    # Ein Schreibvorgang für alle Ergebnisse
+    speichere_eintraege(rows)
+    return pd.DataFrame(rows, columns=CACHE_SPALTEN)
 
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+# Hintergrund-Aktualisierung (stale-while-revalidate): veraltete Einträge werden sofort angezeigt
+# und im Hintergrund neu geladen, häufig gefundene Handwerker zuerst
+
+class HintergrundAktualisierer:
+    """Ein Daemon-Thread je Prozess, der vorgemerkte Handwerker nach Priorität aktualisiert.
+
+    `generation` zählt erfolgreiche Aktualisierungen; ändert sie sich, lohnt sich ein neues load_cache().
+    """
+
+    def __init__(self, requests_per_second: float = HINTERGRUND_REQUESTS_PER_SECOND,
+                 budget_reserve: int = HINTERGRUND_BUDGET_RESERVE, policy: CachePolicy = CACHE_POLICY):
+        self.budget_reserve = budget_reserve
+        self.policy = policy
+        self.generation = 0
+        self._bucket = TokenBucket(requests_per_second, 1)
+        self._cv = threading.Condition()
+        self._haeufigkeit = Counter()
+        self._heap = []
+        self._vorgemerkt = {}          # key -> (name, plz, country), solange in der Queue
+        self._seq = 0
+        self._thread = threading.Thread(target=self._lauf, name="places-aktualisierer", daemon=True)
+        self._thread.start()
+
+    def vormerken(self, alle, veraltet) -> None:
+        # alle: (name, plz, land) aller angezeigten Handwerker (zählt die Häufigkeit),
+        # veraltet: davon die abgelaufenen Einträge, die aktualisiert werden sollen
+        with self._cv:
+            self._haeufigkeit.update(cache_key(*h) for h in alle)
+            for h in veraltet:
+                key = cache_key(*h)
+                self._vorgemerkt[key] = h
+                # Bei erneutem Vormerken mit höherer Priorität nachschieben; alte Heap-Einträge verfallen beim Pop
+                self._seq += 1
+                heapq.heappush(self._heap, (-self._haeufigkeit[key], self._seq, key))
+            self._cv.notify()
+
+    def wartend(self) -> int:
+        with self._cv:
+            return len(self._vorgemerkt)
+
+    def _naechster(self):
+        with self._cv:
+            while True:
+                while self._heap:
+                    _, _, key = heapq.heappop(self._heap)
+                    if key in self._vorgemerkt:
+                        return self._vorgemerkt.pop(key)
+                self._cv.wait()
+
+    def _lauf(self) -> None:
+        while True:
+            name, plz, country = self._naechster()
+            if verbleibendes_budget() <= self.budget_reserve:
+                # Budget für Hintergrund-Abfragen aufgebraucht -> Queue leeren, manuelle Abfragen haben Vorrang
+                with self._cv:
+                    self._vorgemerkt.clear()
+                    self._heap.clear()
+                continue
+            try:
+                # Drosselung je HTTP-Anfrage im Client, nicht nur einmal je Handwerker
+                row = get_handwerker_data(name, plz, country, policy=self.policy, warten=self._bucket.acquire)
+                # nur neue Bewertungen zählen; Fehler lassen den angezeigten Eintrag unverändert
+                if row.get("source") == "google" and row.get("status") == "OK":
+                    with self._cv:
+                        self.generation += 1
+            except Exception as e:
+                print("[AKTUALISIERER] Fehler:", repr(e), file=sys.stderr)
 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -382,4 +903,21 @@ def get_handwerker_data(name, plz, country, df_cache, force_api: bool = False):
 
 
 
-
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Google-Places-Daten für viele Handwerker auf einmal laden")
+    parser.add_argument("--datei", default=os.path.join(".geo_cache", "auftrag_geo.parquet"),
+                        help="Parquet/CSV mit Handwerker_Name, PLZ_HW, Land (Standard: auftrag_geo aus dem Geo-Cache)")
+    parser.add_argument("--parallel", type=int, default=BULK_MAX_PARALLEL)
+    parser.add_argument("--rate", type=float, default=BULK_REQUESTS_PER_SECOND, help="Anfragen pro Sekunde")
+    parser.add_argument("--force", action="store_true", help="auch frische erfolgreiche Cache-Einträge neu abfragen")
+    args = parser.parse_args()
+
+    eingabe = pd.read_csv(args.datei, dtype=str) if args.datei.endswith(".csv") else pd.read_parquet(args.datei)
+    ergebnis = lade_handwerker_bulk(eingabe, force_api=args.force,
+                                    max_parallel=args.parallel, requests_per_second=args.rate)
+    print(ergebnis["status"].value_counts().to_string() if len(ergebnis) else "Alles aktuell im Cache.")
+    stat = cache_statistik()
+    print(f"API-Abfragen: {stat['api_abfragen']}, aus dem Cache beantwortet: {stat['eingespart']}")
+    for endpunkt, m in get_client().metriken().items():
+        print(f"{endpunkt}: {m['aufrufe']} Aufrufe, {m['wiederholungen']} Wiederholungen, "
+              f"{m['fehler']} Fehler, Ø {m['mittel_sekunden'] * 1000:.0f} ms")
@@ -1,20 +1,69 @@
+import json, hashlib
 import pandas as pd
 import numpy as np
 import pgeocode
-import joblib
 from pathlib import Path
+from typing import NamedTuple
 from sklearn.neighbors import BallTree
 import streamlit as st
-from sklearn.metrics.pairwise import haversine_distances
-from data_loader import load_Auftragsdaten
+from data_loader import (
+    load_Auftragsdaten, load_handwerker_dimension, AUFTRAGSDATEN_PFAD, HANDWERKER_DIM_PFAD, BEREINIGUNG_VERSION,
+    PLZ_LAENGE,
+)
 
-ZFILL = {"DE": 5, "AT": 4, "CH": 4}
+ZFILL = PLZ_LAENGE   # PLZ-Länge je Land, eine Quelle für Geo-Index, Dimension und Google-Cache
 R_EARTH_KM = 6371.0
 
+GEO_CACHE_DIR = Path(".geo_cache")
+# Bei Formatänderungen hochzählen -> alter Cache wird verworfen
+GEO_INDEX_VERSION = 4
+
+class PLZIndex(NamedTuple):
+    keys: np.ndarray    # sortiert, Land + PLZ als Bytes (z.B. b"DE01067")
+    coords: np.ndarray  # float32 (n, 2), lat/lon in Grad, gleiche Reihenfolge wie keys
+    positionen: dict    # Schlüssel -> Zeile in keys/coords, für O(1)-Einzelabfragen
+
+class HWIndex(NamedTuple):
+    rows: np.ndarray    # int32, Zeilenposition in auftrag_geo je Baumpunkt
+    coords: np.ndarray  # float32 (m, 2), lat/lon der Handwerker mit bekannter PLZ
+    tree: BallTree      # Haversine-BallTree direkt über den Handwerker-Standorten
+
+def plz_schluessel(land, plz) -> np.ndarray:
+    # Breite aus den Daten bestimmen: ein festes "S7" würde längere Schlüssel stillschweigend abschneiden
+    keys = pd.Series(land, dtype=str).str.upper() + pd.Series(plz, dtype=str)
+    breite = int(keys.str.len().max()) if len(keys) else 1
+    return keys.to_numpy(dtype=f"S{max(breite, 1)}")
+
 @st.cache_resource
 def nomi(country: str) -> pgeocode.Nominatim:
     return pgeocode.Nominatim(country)
 
+def plz_index_aus_arrays(keys: np.ndarray, coords: np.ndarray) -> PLZIndex:
+    return PLZIndex(keys=keys, coords=coords, positionen=dict(zip(keys.tolist(), range(len(keys)))))
+
+def normalisiere_plz(land, plz) -> pd.Series:
+    land = pd.Series(land, dtype=str).str.strip().str.upper()
+    plz = pd.Series(plz, dtype=str).str.replace(" ", "").str.strip()
+    return pd.Series(np.where(land.eq("DE"), plz.str.zfill(5), plz.str.zfill(4)), index=plz.index)
+
+def geokodiere_vektor(plz_index: PLZIndex, land, plz) -> np.ndarray:
+    # Binärsuche im sortierten Schlüssel-Array; unbekannte PLZ -> NaN
+    keys = plz_schluessel(land, normalisiere_plz(land, plz))
+    pos = np.searchsorted(plz_index.keys, keys).clip(max=len(plz_index.keys) - 1)
+    gefunden = plz_index.keys[pos] == keys
+    coords = np.full((len(keys), 2), np.nan)
+    coords[gefunden] = plz_index.coords[pos[gefunden]]
+    return coords
+
+def geokodiere(plz_index: PLZIndex, land: str, plz: str) -> tuple[float, float] | None:
+    land = str(land).strip().upper()
+    key = (land + str(plz).replace(" ", "").strip().zfill(ZFILL.get(land, 4))).encode()
+    pos = plz_index.positionen.get(key)
+    if pos is None:
+        return None
+    lat, lon = plz_index.coords[pos]
+    return float(lat), float(lon)
+
 @st.cache_data
 def build_plz_koordinaten() -> pd.DataFrame:
     frames = []
@@ -27,7 +76,8 @@ def build_plz_koordinaten() -> pd.DataFrame:
     return pd.concat(frames, ignore_index=True)
 
 @st.cache_resource
-def build_auftrag_geo_from_df(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, BallTree]:
+def build_auftrag_geo_from_df(df: pd.DataFrame) -> tuple[pd.DataFrame, PLZIndex]:
+    # df: eine Zeile je Handwerker (HW_ID, Handwerker_Name, Land, PLZ_HW), z.B. aus der Handwerker-Dimension
     df = df.copy()
     df["Land"] = df["Land"].astype(str).str.strip().str.upper()
     df["PLZ_HW"] = df["PLZ_HW"].astype(str).str.strip()
@@ -41,69 +91,170 @@ def build_auftrag_geo_from_df(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFr
     dach = build_plz_koordinaten()
 
     auftrag_geo = (
-        df.groupby("Handwerker_Name", as_index=False)[["Land", "PLZ_HW"]].first()
+        df[["HW_ID", "Handwerker_Name", "Land", "PLZ_HW"]].drop_duplicates("HW_ID").sort_values("HW_ID")
           .merge(dach, on=["Land", "PLZ_HW"], how="left")
     )
 
-    plz_coords = (
-        dach.rename(columns={"latitude": "lat", "longitude": "lon"})
-           .set_index(["Land", "PLZ_HW"])[["lat", "lon"]]
+    keys = plz_schluessel(dach["Land"], dach["PLZ_HW"])
+    order = np.argsort(keys, kind="stable")
+    plz_index = plz_index_aus_arrays(
+        keys[order], dach[["latitude", "longitude"]].to_numpy(dtype=np.float32)[order]
     )
+    return auftrag_geo, plz_index
 
-    tree = BallTree(np.radians(plz_coords.to_numpy()), metric="haversine")
-    return auftrag_geo, plz_coords, tree
+def _geo_fingerprint() -> str:
+    # Quelle ändert sich -> Größe/mtime von Auftragsdaten, Handwerker-Dimension bzw. pgeocode-Dateien ändern sich
+    h = hashlib.sha1(f"v{GEO_INDEX_VERSION}|b{BEREINIGUNG_VERSION}|pgeocode {pgeocode.__version__}".encode())
+    quellen = [Path(AUFTRAGSDATEN_PFAD), Path(HANDWERKER_DIM_PFAD)] + [Path(pgeocode.STORAGE_DIR) / f"{c}.txt" for c in ZFILL]
+    for pfad in quellen:
+        stat = pfad.stat() if pfad.exists() else None
+        h.update(f"{pfad}|{stat.st_size if stat else '-'}|{stat.st_mtime_ns if stat else '-'}".encode())
+    return h.hexdigest()
 
 @st.cache_resource
 def get_geo_strukturen():
-    cache_dir = Path(".geo_cache")
-    cache_dir.mkdir(exist_ok=True)
-
-    f_auftrag = cache_dir / "auftrag_geo.parquet"
-    f_plz     = cache_dir / "plz_coords.parquet"
-    f_tree    = cache_dir / "tree.joblib"
-    
-    if f_auftrag.exists() and f_plz.exists() and f_tree.exists():
+    GEO_CACHE_DIR.mkdir(exist_ok=True)
+
+    f_meta    = GEO_CACHE_DIR / "meta.json"
+    f_auftrag = GEO_CACHE_DIR / "auftrag_geo.parquet"
+    f_keys    = GEO_CACHE_DIR / "plz_keys.npy"
+    f_coords  = GEO_CACHE_DIR / "plz_coords.npy"
+    f_hw_rows = GEO_CACHE_DIR / "hw_rows.npy"
+    f_hw_coords = GEO_CACHE_DIR / "hw_coords.npy"
+
+    meta = json.loads(f_meta.read_text("utf-8")) if f_meta.exists() else {}
+
+    if meta.get("fingerprint") == _geo_fingerprint():
         auftrag_geo = pd.read_parquet(f_auftrag)
+        # Flache Arrays per memmap öffnen: kein Unpickling, Seiten werden zwischen Prozessen geteilt
+        plz_index = plz_index_aus_arrays(np.load(f_keys, mmap_mode="r"), np.load(f_coords, mmap_mode="r"))
+        hw_rows, hw_coords = np.load(f_hw_rows, mmap_mode="r"), np.load(f_hw_coords, mmap_mode="r")
+    else:
+        # Ein Geo-Punkt je Handwerker-ID, die in den bereinigten Auftragsdaten vorkommt
+        dim = load_handwerker_dimension()
+        ids = load_Auftragsdaten(["HW_ID"])["HW_ID"].unique()
+        auftrag_geo, plz_index = build_auftrag_geo_from_df(dim[dim["HW_ID"].isin(ids)])
+
+        auftrag_geo.to_parquet(f_auftrag, index=False)
+        np.save(f_keys, plz_index.keys)
+        np.save(f_coords, plz_index.coords)
 
-        plz_coords_df = pd.read_parquet(f_plz)
-        plz_coords = plz_coords_df.set_index(["Land", "PLZ_HW"])[["lat", "lon"]]
+        gueltig = auftrag_geo[["latitude", "longitude"]].notna().all(axis=1).to_numpy()
+        hw_rows = np.flatnonzero(gueltig).astype(np.int32)
+        hw_coords = auftrag_geo.loc[gueltig, ["latitude", "longitude"]].to_numpy(dtype=np.float32)
+        np.save(f_hw_rows, hw_rows)
+        np.save(f_hw_coords, hw_coords)
+        # meta zuletzt schreiben -> halbfertiger Cache wird beim nächsten Start neu gebaut
+        f_meta.write_text(json.dumps({"version": GEO_INDEX_VERSION, "fingerprint": _geo_fingerprint()}), "utf-8")
 
-        tree = joblib.load(f_tree)
-        return auftrag_geo, plz_coords, tree
+    tree = BallTree(np.radians(hw_coords.astype(np.float64)), metric="haversine")
+    return auftrag_geo, plz_index, HWIndex(rows=hw_rows, coords=hw_coords, tree=tree)
 
-    auftrag_geo, plz_coords, tree = build_auftrag_geo_from_df(load_Auftragsdaten())
+def entfernungsscore(d_km) -> pd.Categorical:
+    return pd.cut(
+        d_km, bins=[0, 5, 20, 40, 60, 80, 101],
+        labels=["100", "80", "60", "40", "20", "0"],
+        include_lowest=True,
+    )
 
-    auftrag_geo.to_parquet(f_auftrag, index=False)
-    plz_coords.reset_index().to_parquet(f_plz, index=False)  # Index flach speichern
-    joblib.dump(tree, f_tree)
+def datensaetze_im_umkreis(input_plz: str, radius_km: float, country: str, auftrag_geo: pd.DataFrame, plz_index: PLZIndex, hw_index: HWIndex) -> pd.DataFrame:
+    # auftrag_geo darf eine (per Maske gefilterte) Teilmenge des gecachten auftrag_geo sein
+    coord = geokodiere(plz_index, country, input_plz)
+    if coord is None:
+        raise ValueError(f"PLZ {input_plz} nicht gefunden (Land: {country})")
 
-    return auftrag_geo, plz_coords, tree
+    coord0 = np.radians([coord])
+    ind, dist = hw_index.tree.query_radius(
+        coord0, r=radius_km / R_EARTH_KM, return_distance=True, sort_results=True
+    )
 
-def datensaetze_im_umkreis(input_plz: str, radius_km: float, country: str, auftrag_geo: pd.DataFrame, plz_coords: pd.DataFrame,tree: BallTree) -> pd.DataFrame:
+    pos = auftrag_geo.index.get_indexer(hw_index.rows[ind[0]])
+    keep = pos >= 0
+    d_km = dist[0][keep] * R_EARTH_KM
 
-    info = nomi(country).query_postal_code(input_plz)
-    if pd.isna(info.latitude) or pd.isna(info.longitude):
+    return auftrag_geo.iloc[pos[keep]].assign(
+        **{
+            "Entfernung in km": d_km,
+            "Entfernungsscore": entfernungsscore(d_km),
+        }
+    )
+
+def k_naechste_handwerker(input_plz: str, k: int, country: str, auftrag_geo: pd.DataFrame, plz_index: PLZIndex, hw_index: HWIndex, max_km: float | None = None) -> pd.DataFrame:
+    # kNN statt fester Radius: die k nächsten Handwerker aus auftrag_geo (ggf. gefilterte Teilmenge) in einem Durchlauf
+    coord = geokodiere(plz_index, country, input_plz)
+    if coord is None:
         raise ValueError(f"PLZ {input_plz} nicht gefunden (Land: {country})")
 
-    coord0 = np.radians([[info.latitude, info.longitude]])
-    idx = tree.query_radius(coord0, r=radius_km / R_EARTH_KM)[0]
+    pos = auftrag_geo.index.get_indexer(hw_index.rows)
+    auswahl = pos >= 0
 
-    nearby_pairs = plz_coords.iloc[idx].reset_index()[["Land", "PLZ_HW"]].drop_duplicates()
-    result = auftrag_geo.merge(nearby_pairs, on=["Land", "PLZ_HW"], how="inner")
+    k = min(int(k), int(auswahl.sum()))
+    if k == 0:
+        return auftrag_geo.iloc[:0].assign(**{"Entfernung in km": [], "Entfernungsscore": []})
 
-    if result.empty:
-        return result
+    if auswahl.all():
+        tree = hw_index.tree
+    else:
+        # Baum nur über die gefilterten Handwerker, damit k Treffer auch wirklich k Handwerker sind
+        tree = BallTree(np.radians(hw_index.coords[auswahl].astype(np.float64)), metric="haversine")
+        pos = pos[auswahl]
 
-    d_km = haversine_distances(coord0, np.radians(result[["latitude", "longitude"]].to_numpy()))[0] * R_EARTH_KM
-    result = result.assign(
+    dist, ind = tree.query(np.radians([coord]), k=k)
+    d_km = dist[0] * R_EARTH_KM
+    treffer = pos[ind[0]]
+    if max_km is not None:
+        treffer, d_km = treffer[d_km <= max_km], d_km[d_km <= max_km]
+
+    return auftrag_geo.iloc[treffer].assign(
         **{
             "Entfernung in km": d_km,
-            "Entfernungsscore": pd.cut(
-                d_km, bins=[0, 5, 20, 40, 60, 80, 101],
-                labels=["100", "80", "60", "40", "20", "0"],
-                include_lowest=True,
-            )
+            "Entfernungsscore": entfernungsscore(d_km),
         }
-    ).sort_values("Entfernung in km")
+    )
 
-    return result
\ No newline at end of file
+def datensaetze_im_umkreis_batch(claims: pd.DataFrame, auftrag_geo: pd.DataFrame, plz_index: PLZIndex, hw_index: HWIndex, filter_hw: dict | None = None) -> pd.DataFrame:
+    # claims: Spalten claim_id, PLZ, Land, radius_km und optional Filter.
+    # filter_hw bildet jeden Filter-Wert auf die zulässigen HW_IDs ab (z.B. aus lade_aggregat).
+    # Ergebnis im Long-Format: eine Zeile je (claim_id, Handwerker), Claims ohne gültige PLZ fehlen.
+    coords = geokodiere_vektor(plz_index, claims["Land"], claims["PLZ"])
+    ok = ~np.isnan(coords).any(axis=1)
+    claims = claims[ok]
+    spalten = ["HW_ID", "Handwerker_Name", "Land", "PLZ_HW"]
+    if not ok.any():
+        # query_radius lehnt ein leeres (0, 2)-Array ab
+        return auftrag_geo.iloc[:0][spalten].assign(
+            claim_id=pd.Series(dtype=claims["claim_id"].dtype), **{"Entfernung in km": [], "Entfernungsscore": []}
+        )[["claim_id", *spalten, "Entfernung in km", "Entfernungsscore"]]
+
+    ind, dist = hw_index.tree.query_radius(
+        np.radians(coords[ok]),
+        r=claims["radius_km"].to_numpy(dtype=float) / R_EARTH_KM,
+        return_distance=True, sort_results=True,
+    )
+    anzahl = np.fromiter((len(i) for i in ind), int, count=len(ind))
+    claim_pos = np.repeat(np.arange(len(claims)), anzahl)
+    d_km = np.concatenate(dist) * R_EARTH_KM
+
+    # Baumpunkte über den Index auf auftrag_geo abbilden: auftrag_geo darf eine gefilterte Teilmenge sein
+    rows = auftrag_geo.index.get_indexer(hw_index.rows[np.concatenate(ind)])
+    im_frame = rows >= 0
+    claim_pos, rows, d_km = claim_pos[im_frame], rows[im_frame], d_km[im_frame]
+
+    if filter_hw is not None and "Filter" in claims:
+        # Eine Maske je Filter-Wert über alle auftrag_geo-Zeilen, Claims ohne Filter sehen alle Handwerker
+        werte, codes = np.unique(claims["Filter"].fillna("").astype(str), return_inverse=True)
+        masken = np.vstack([
+            auftrag_geo["HW_ID"].isin(filter_hw.get(w, ())).to_numpy() if w else np.ones(len(auftrag_geo), bool)
+            for w in werte
+        ])
+        keep = masken[codes[claim_pos], rows]
+        claim_pos, rows, d_km = claim_pos[keep], rows[keep], d_km[keep]
+
+    result = auftrag_geo.iloc[rows][spalten].reset_index(drop=True)
+    result.insert(0, "claim_id", claims["claim_id"].to_numpy()[claim_pos])
+    return result.assign(
+        **{
+            "Entfernung in km": d_km,
+            "Entfernungsscore": entfernungsscore(d_km),
+        }
+    )
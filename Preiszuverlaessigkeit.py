@@ -0,0 +1,52 @@
+import math
+import pandas as pd
+import numpy as np
+
+def wilson_lower_bound(p: float, n: int, z: float = 1.64) -> float:
+    if n <= 0 or p <= 0: 
+        return 0.0
+    z2 = z * z
+    return max(0.0, (p + z2/(2*n) - z*math.sqrt(p*(1-p)/n + z2/(4*n*n))) / (1 + z2/n))
+
+def wilson_lower_bound_np(p, n, z: float = 1.64) -> np.ndarray:
+    # Array-Variante von wilson_lower_bound (gleiche Randfälle n<=0 / p<=0 -> 0)
+    p = np.asarray(p, dtype=float)
+    n = np.asarray(n, dtype=float)
+    gueltig = (n > 0) & (p > 0)
+    n = np.where(gueltig, n, 1.0)
+    z2 = z * z
+    with np.errstate(invalid="ignore"):
+        wert = (p + z2/(2*n) - z*np.sqrt(p*(1-p)/n + z2/(4*n*n))) / (1 + z2/n)
+    return np.where(gueltig, np.maximum(0.0, wert), 0.0)
+
+def verhaeltnis(df: pd.DataFrame) -> pd.Series:
+    return (
+        df["Einigung_Netto"].div(df["Forderung_Netto"])
+        .replace([np.inf, -np.inf], 1).fillna(1).clip(upper=1)
+    )
+
+def berechne_zuverlaessigkeit(df: pd.DataFrame, z: float = 1.64, schluessel: str = "Handwerker_Name") -> pd.DataFrame:
+    # schluessel: Spalte, die einen Handwerker identifiziert (z.B. "HW_ID" für Integer-Gruppierung)
+    dfz = df[[schluessel]].assign(Verhaeltnis=verhaeltnis(df))
+
+    agg = dfz.groupby(schluessel)["Verhaeltnis"].agg(
+        verhaeltnis_summe="sum", n_jobs="size"
+    ).reset_index()
+
+    return berechne_zuverlaessigkeit_aggregiert(agg, z, schluessel)
+
+def berechne_zuverlaessigkeit_aggregiert(agg: pd.DataFrame, z: float = 1.64, schluessel: str = "Handwerker_Name") -> pd.DataFrame:
+    # agg: vorberechnete Summen (verhaeltnis_summe, n_jobs), ggf. mehrere Zeilen je Handwerker
+    result = agg.groupby(schluessel, as_index=False)[["verhaeltnis_summe", "n_jobs"]].sum()
+
+    result["Preiszuverlässigkeitsscore"] = (result["verhaeltnis_summe"] / result["n_jobs"] * 100).clip(0, 100)
+    result = result[[schluessel, "Preiszuverlässigkeitsscore", "n_jobs"]]
+
+    p = result["Preiszuverlässigkeitsscore"].to_numpy() / 100
+    n = result["n_jobs"].to_numpy()
+
+    wilson = wilson_lower_bound_np(p, n, z)
+    conf = np.minimum(1.0, np.divide(wilson, p, out=np.zeros_like(wilson), where=p > 0))
+    result["zuverlaessigkeit_wilson"] = result["Preiszuverlässigkeitsscore"] * conf
+    
+    return result
@@ -1,7 +1,9 @@
 # Zählung der Handwerker
 import pandas as pd
+from data_loader import load_Auftragsdaten
 
-df = pd.read_parquet('/Users/benab/Desktop/Projekt/Auftragsdaten.parquet')
+# bereinigte Auftragsdaten, nur die benötigte Spalte
+df = load_Auftragsdaten(["Handwerker_Name"])
 
 hc = df['Handwerker_Name'].value_counts().reset_index()
 hc.columns = ['Handwerker_Name', 'Häufigkeit']
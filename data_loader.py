@@ -1,27 +1,57 @@
+import os
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-@st.cache_data
-def load_Auftragsdaten() -> pd.DataFrame:
-    df = pd.read_parquet("/Users/benab/Desktop/Projekt/Auftragsdaten.parquet")
+AUFTRAGSDATEN_PFAD = "/Users/benab/Desktop/Projekt/Auftragsdaten.parquet"
+POSITIONSDATEN_PFAD = "/Users/benab/Desktop/Projekt/Positionsdaten.parquet"
+# Bereinigte, typisierte Fassung von Auftragsdaten – wird einmal gebaut und danach nur noch spaltenweise gelesen
+AUFTRAGSDATEN_BEREINIGT_PFAD = "/Users/benab/Desktop/Projekt/Auftragsdaten_bereinigt.parquet"
+# Handwerker-Dimension: stabile int32-ID je normalisiertem (Name, PLZ, Land); IDs werden nie neu vergeben
+HANDWERKER_DIM_PFAD = "/Users/benab/Desktop/Projekt/Handwerker_Dimension.parquet"
+
+# Bei Änderungen an bereinige_Auftragsdaten hochzählen -> erzwingt Neuaufbau
+BEREINIGUNG_VERSION = 3
+KATEGORIE_SPALTEN = ["Land", "Gewerk_Name", "Schadenart_Name", "Falltyp_Name"]
+PLZ_LAENGE = {"DE": 5, "AT": 4, "CH": 4}
+DIM_SCHLUESSEL = ["name_key", "plz_key", "land_key"]
+DIM_SPALTEN = ["HW_ID", "Handwerker_Name", "PLZ_HW", "Land", *DIM_SCHLUESSEL]
+ROW_GROUP_GROESSE = 100_000
+BATCH_ZEILEN = 200_000
+
+# Zeilenfilter schon beim Parquet-Scan (ausgeschlossene Zeilen werden nie zu pandas):
+# - Handwerker-Namen von Vermieter/Eigenleistung/Sachcontrol/"(leer)" – "(leer)" ist eine Regex-Gruppe,
+#   trifft also jedes "leer" im Namen; fehlende Namen bleiben wie bei str.contains(na=False) erhalten
+# - negative Beträge und Ausreißer (Forderung >= 1000 und Einigung >= doppelte Forderung)
+_name, _forderung, _einigung = ds.field("Handwerker_Name"), ds.field("Forderung_Netto"), ds.field("Einigung_Netto")
+AUSSCHLUSS_FILTER = (
+    # Kleene-Logik: "~null | True" ist True -> Zeilen ohne Namen bleiben
+    (~pc.match_substring_regex(_name, pattern="vonovia|eigenleistung|sachcontrol|(leer)", ignore_case=True)
+     | _name.is_null())
+    & (_forderung >= 0)
+    & (_einigung >= 0)
+    & ~((_forderung >= 1000) & (_einigung >= _forderung * 2))
+)
 
+
+def bereinige_Auftragsdaten(df: pd.DataFrame) -> pd.DataFrame:
+    # erwartet bereits per AUSSCHLUSS_FILTER gefilterte Rohdaten
     df["PLZ_HW"] = (
         df["PLZ_HW"].astype(str)
         .str.replace(r"\D", "", regex=True)
         .replace("", pd.NA)
     )
     df = df.dropna(subset=["PLZ_HW"])
-    
+
     df["Land"] = (
         df["Land"]
         .replace("-", pd.NA)
         .fillna(df["DH_ID"].map({1: "DE", 2: "AT", 4: "CH"}))
     )
-    df = df[
-        ~df["Handwerker_Name"].str.contains(
-            r"vonovia|eigenleistung|sachcontrol|(leer)", case=False, na=False
-            )
-    ]
 
     df = df.assign(
         Gewerk_Name=df["Gewerk_Name"].replace("(leer)", "Sonstiges"),
@@ -31,18 +61,145 @@ def load_Auftragsdaten() -> pd.DataFrame:
         }),
         Falltyp_Name=df["Falltyp_Name"].replace("-", "Sonstiges"),
     )
-    
-    df = df[
-        (df["Forderung_Netto"] >= 0) &
-        (df["Einigung_Netto"] >= 0) &
-        ~(
-            (df["Forderung_Netto"] >= 1000) &
-            (df["Einigung_Netto"] >= 2 * df["Forderung_Netto"])
+
+    # Typen einmal festlegen: PLZ als String, wenige Ausprägungen als Kategorie
+    return df.astype({"PLZ_HW": str, **{c: "category" for c in KATEGORIE_SPALTEN}}).reset_index(drop=True)
+
+def handwerker_schluessel(name: pd.Series, plz: pd.Series, land: pd.Series) -> pd.DataFrame:
+    # Normalisierung wie beim Google-Cache: Name klein/ohne Rand-Leerzeichen, PLZ je Land auf feste Länge
+    land = land.astype(str).str.strip().str.upper()
+    plz = plz.astype(str).str.strip()
+    plz = np.select(
+        [land.eq(l).to_numpy() for l in PLZ_LAENGE],
+        [plz.str.zfill(z).to_numpy() for z in PLZ_LAENGE.values()],
+        default=plz.to_numpy(),
+    )
+    return pd.DataFrame({
+        "name_key": name.astype(str).str.lower().str.strip().to_numpy(),
+        "plz_key": plz.astype(str),
+        "land_key": land.to_numpy(),
+    })
+
+def handwerker_schluessel_einzeln(name, plz, land) -> tuple[str, str, str]:
+    # Skalare Variante von handwerker_schluessel mit denselben Regeln (z.B. für den Google-Cache)
+    land = str(land).strip().upper()
+    plz = str(plz).strip()
+    laenge = PLZ_LAENGE.get(land)
+    return str(name).lower().strip(), plz.zfill(laenge) if laenge else plz, land
+
+def _schreibe_atomar(tabelle: pa.Table, pfad: str) -> None:
+    # erst temporär schreiben, dann umbenennen -> Leser sehen nie eine halbe Datei
+    tmp = pfad + ".tmp"
+    pq.write_table(tabelle, tmp, row_group_size=ROW_GROUP_GROESSE)
+    os.replace(tmp, pfad)
+
+def lade_dimension_fuer_build() -> pd.DataFrame:
+    if os.path.exists(HANDWERKER_DIM_PFAD):
+        return pd.read_parquet(HANDWERKER_DIM_PFAD)
+    return pd.DataFrame({"HW_ID": pd.Series(dtype="int32"), **{c: pd.Series(dtype=str) for c in DIM_SPALTEN[1:]}})
+
+def aktualisiere_handwerker_dimension(df: pd.DataFrame, dim: pd.DataFrame) -> tuple[pd.Series, pd.DataFrame]:
+    # Bekannte Handwerker behalten ihre ID, neue bekommen fortlaufende IDs hinter der bisher größten.
+    # Liefert die IDs zu df und die ggf. erweiterte Dimension (geschrieben wird sie vom Aufrufer)
+    schluessel = handwerker_schluessel(df["Handwerker_Name"], df["PLZ_HW"], df["Land"])
+
+    neu = (
+        schluessel.assign(Handwerker_Name=df["Handwerker_Name"].to_numpy())
+        .drop_duplicates(DIM_SCHLUESSEL)
+        .merge(dim[DIM_SCHLUESSEL], on=DIM_SCHLUESSEL, how="left", indicator=True)
+        .query("_merge == 'left_only'")
+        .sort_values(DIM_SCHLUESSEL, kind="stable")
+    )
+    if len(neu):
+        start = int(dim["HW_ID"].max()) + 1 if len(dim) else 0
+        neu = neu.assign(
+            HW_ID=np.arange(start, start + len(neu), dtype=np.int32),
+            PLZ_HW=neu["plz_key"],
+            Land=neu["land_key"],
         )
-    ]
+        dim = pd.concat([dim, neu[DIM_SPALTEN]], ignore_index=True).astype({"HW_ID": "int32"})
+
+    ids = schluessel.merge(dim[["HW_ID", *DIM_SCHLUESSEL]], on=DIM_SCHLUESSEL, how="left")["HW_ID"]
+    return pd.Series(ids.to_numpy(dtype=np.int32), index=df.index, name="HW_ID"), dim
+
+@st.cache_data
+def _lade_dimension(stand: int) -> pd.DataFrame:
+    return pd.read_parquet(HANDWERKER_DIM_PFAD, columns=DIM_SPALTEN)
+
+def load_handwerker_dimension() -> pd.DataFrame:
+    # stand = mtime der Dimension -> nach jedem Build neu eingelesen
+    if not bereinigt_aktuell():
+        build_Auftragsdaten_bereinigt()
+    return _lade_dimension(os.stat(HANDWERKER_DIM_PFAD).st_mtime_ns)
 
-    return df
+def _quell_stempel() -> str:
+    quelle = os.stat(AUFTRAGSDATEN_PFAD)
+    return f"v{BEREINIGUNG_VERSION}|{quelle.st_size}|{quelle.st_mtime_ns}"
+
+def bereinigt_aktuell() -> bool:
+    # Nur den Footer lesen: Stempel der Quelle steht in den Schema-Metadaten
+    if not os.path.exists(AUFTRAGSDATEN_BEREINIGT_PFAD):
+        return False
+    meta = pq.read_schema(AUFTRAGSDATEN_BEREINIGT_PFAD).metadata or {}
+    return meta.get(b"quelle") == _quell_stempel().encode()
+
+def build_Auftragsdaten_bereinigt() -> None:
+    # Gestreamt: Rohdaten batchweise scannen, bereinigen und row-group-weise schreiben.
+    # Im Speicher liegen nur ein Batch, eine Row-Group und die Handwerker-Dimension.
+    dim = lade_dimension_fuer_build()
+    scanner = ds.dataset(AUFTRAGSDATEN_PFAD, format="parquet").scanner(filter=AUSSCHLUSS_FILTER, batch_size=BATCH_ZEILEN)
+    tmp = AUFTRAGSDATEN_BEREINIGT_PFAD + ".tmp"
+    writer, schema, puffer, gepuffert = None, None, [], 0
+    try:
+        for batch in scanner.to_batches():
+            if not batch.num_rows:
+                continue
+            df = bereinige_Auftragsdaten(batch.to_pandas())
+            ids, dim = aktualisiere_handwerker_dimension(df, dim)
+            df.insert(0, "HW_ID", ids.to_numpy())
+            tabelle = pa.Table.from_pandas(df, preserve_index=False)
+            if schema is None:
+                # Kategorien je Batch unterschiedlich -> einheitlicher Dictionary-Typ für die ganze Datei
+                schema = pa.schema([
+                    f.with_type(pa.dictionary(pa.int32(), f.type.value_type)) if pa.types.is_dictionary(f.type) else f
+                    for f in tabelle.schema
+                ], metadata={**(tabelle.schema.metadata or {}), b"quelle": _quell_stempel().encode()})
+                writer = pq.ParquetWriter(tmp, schema)
+            puffer.append(tabelle.cast(schema))
+            gepuffert += len(tabelle)
+            if gepuffert >= ROW_GROUP_GROESSE:
+                # nur ganze Row-Groups schreiben, der Rest bleibt für die nächste gepuffert
+                voll = gepuffert - gepuffert % ROW_GROUP_GROESSE
+                gesamt = pa.concat_tables(puffer)
+                writer.write_table(gesamt.slice(0, voll), row_group_size=ROW_GROUP_GROESSE)
+                puffer, gepuffert = [gesamt.slice(voll)], gepuffert - voll
+        if writer is None:
+            # keine Zeile übrig: leere Datei mit dem Schema einer bereinigten Leer-Tabelle
+            leer = bereinige_Auftragsdaten(scanner.projected_schema.empty_table().to_pandas())
+            leer.insert(0, "HW_ID", pd.Series(dtype="int32"))
+            schema = pa.Schema.from_pandas(leer, preserve_index=False).with_metadata({b"quelle": _quell_stempel().encode()})
+            writer = pq.ParquetWriter(tmp, schema)
+        if puffer:
+            writer.write_table(pa.concat_tables(puffer), row_group_size=ROW_GROUP_GROESSE)
+    finally:
+        if writer is not None:
+            writer.close()
+    # Dimension vor den Auftragsdaten ersetzen: jede HW_ID in der neuen Datei ist dann schon bekannt
+    _schreibe_atomar(pa.Table.from_pandas(dim[DIM_SPALTEN], preserve_index=False), HANDWERKER_DIM_PFAD)
+    os.replace(tmp, AUFTRAGSDATEN_BEREINIGT_PFAD)
+
+@st.cache_data
+def load_Auftragsdaten(columns: list[str] | None = None) -> pd.DataFrame:
+    # Bereinigung passiert beim Build; hier nur noch die benötigten Spalten lesen
+    if not bereinigt_aktuell():
+        build_Auftragsdaten_bereinigt()
+    return pd.read_parquet(AUFTRAGSDATEN_BEREINIGT_PFAD, columns=columns)
 
 @st.cache_data
-def load_Positionsdaten():
-    return pd.read_parquet("/Users/benab/Desktop/Projekt/Positionsdaten.parquet")
\ No newline at end of file
+def load_Positionsdaten(columns: list[str] | None = None):
+    return pd.read_parquet(POSITIONSDATEN_PFAD, columns=columns)
+
+
+if __name__ == "__main__":
+    build_Auftragsdaten_bereinigt()
+    print(f"Bereinigte Auftragsdaten geschrieben: {AUFTRAGSDATEN_BEREINIGT_PFAD}")
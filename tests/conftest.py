@@ -0,0 +1,22 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# Module liegen flach im Projektordner
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# GooglePlaces_neu bricht ohne Key beim Import ab; für die Tests genügt ein Platzhalter
+os.environ.setdefault("GOOGLE_PLACES_API_KEY", "test-key")
+
+
+@pytest.fixture
+def places(tmp_path, monkeypatch):
+    # GooglePlaces_neu mit eigener SQLite-Datei je Test und ohne gesetzten Client
+    import GooglePlaces_neu as G
+    monkeypatch.setattr(G, "CACHE_DB_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(G, "_local", threading.local())
+    G.set_client(None)
+    yield G
+    G.set_client(None)
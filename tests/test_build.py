@@ -0,0 +1,24 @@
+import numpy as np
+import pyarrow as pa
+
+import Auftrags_und_Positionsdaten as A
+
+
+def test_id_bucket_gleiche_ids_gleicher_bucket():
+    ids = pa.array(np.arange(10_000, dtype="int64"))
+    b = A.id_bucket(ids, pa.int64(), 16)
+    assert b.min() >= 0 and b.max() < 16
+    # gleiche ID aus einer Auftragsspalte mit anderem Typ (z.B. float wegen NULLs) landet im selben Bucket
+    np.testing.assert_array_equal(A.id_bucket(pa.array(np.arange(10_000, dtype="float64")), pa.int64(), 16), b)
+    # alle Buckets werden genutzt
+    assert len(np.unique(b)) == 16
+
+
+def test_id_bucket_null_in_bucket_null():
+    b = A.id_bucket(pa.array([None, 3, None], pa.int64()), pa.int64(), 8)
+    assert b[0] == 0 and b[2] == 0
+    assert b[1] == A.id_bucket(pa.array([3], pa.int64()), pa.int64(), 8)[0]
+
+
+def test_id_bucket_ein_bucket():
+    assert A.id_bucket(pa.array(["a", None]), pa.string(), 1).tolist() == [0, 0]
@@ -0,0 +1,257 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pandas as pd
+import pytest
+
+
+def _eintrag(G, status="OK", alter=pd.Timedelta(0), place_id="p1"):
+    zeit = pd.Timestamp.now(tz="UTC") - alter
+    return {
+        "status": status, "place_id": place_id, "last_updated": zeit,
+        "place_id_updated": zeit, **{f"{g}_updated": zeit for g in G.FELDGRUPPEN},
+    }
+
+
+def test_abfrage_noetig_frischer_eintrag(places):
+    assert places.CACHE_POLICY.abfrage_noetig(_eintrag(places)) is False
+
+
+def test_abfrage_noetig_ohne_eintrag(places):
+    assert places.CACHE_POLICY.abfrage_noetig(None) is True
+
+
+def test_abfrage_noetig_force_api(places):
+    assert places.CACHE_POLICY.abfrage_noetig(_eintrag(places), force_api=True) is True
+
+
+def test_abfrage_noetig_nur_bewertung_abgelaufen(places):
+    policy = places.CACHE_POLICY
+    eintrag = _eintrag(places)
+    eintrag["bewertung_updated"] -= policy.ttl_bewertung + pd.Timedelta(days=1)
+    assert policy.abfrage_noetig(eintrag) is True
+    assert policy.faellig(eintrag) == (False, ["bewertung"])
+
+
+def test_abfrage_noetig_ohne_place_id(places):
+    assert places.CACHE_POLICY.abfrage_noetig(_eintrag(places, place_id=None)) is True
+
+
+def test_gueltig_folgt_abfrage_noetig(places):
+    policy = places.CACHE_POLICY
+    frisch, alt = _eintrag(places), _eintrag(places, alter=policy.ttl_stammdaten + pd.Timedelta(days=1))
+    assert policy.gueltig(frisch) and not policy.gueltig(frisch, force_api=True)
+    assert not policy.gueltig(alt)
+
+
+def test_gueltig_negative_eintraege_trotz_force_api(places):
+    policy = places.CACHE_POLICY
+    assert policy.gueltig(_eintrag(places, status="ZERO_RESULTS"), force_api=True)
+    assert not policy.gueltig(_eintrag(places, status="ERROR", alter=policy.ttl_fehler + pd.Timedelta(minutes=1)))
+
+
+@pytest.mark.parametrize("name, plz, land", [
+    (" Maler Müller ", "1011", "DE"), ("Dach Schmidt", "1010", " at "), ("Holz AG", "8001", "CH"),
+    ("Bau GmbH", "", "DE"), ("Bau GmbH", "", "FR"), ("Bau GmbH", "75001", "fr"),
+])
+def test_cache_key_wie_handwerker_dimension(places, name, plz, land):
+    from data_loader import handwerker_schluessel
+    dim = handwerker_schluessel(pd.Series([name]), pd.Series([plz]), pd.Series([land]))
+    assert places.cache_key(name, plz, land) == tuple(dim.iloc[0])
+
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# lade_handwerker_bulk gegen einen lokalen Fake-Server (http.server)
+
+OK_SUCHE = (200, {"status": "OK", "results": [{"place_id": "p1"}]})
+OK_DETAILS = (200, {"status": "OK", "result": {"name": "Maler Müller", "rating": 4.5, "user_ratings_total": 12}})
+
+
+class FakeGoogle:
+    """Antwortet je Endpunkt der Reihe nach aus `antworten`; die letzte Antwort wiederholt sich."""
+
+    def __init__(self):
+        self.antworten = {"textsearch": [OK_SUCHE], "details": [OK_DETAILS]}
+        self.anfragen = []
+        self.lock = threading.Lock()
+
+    def antwort(self, endpunkt):
+        with self.lock:
+            self.anfragen.append(endpunkt)
+            liste = self.antworten[endpunkt]
+            return liste.pop(0) if len(liste) > 1 else liste[0]
+
+
+@pytest.fixture
+def google(places, monkeypatch):
+    for var in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy", "ALL_PROXY", "all_proxy"):
+        monkeypatch.delenv(var, raising=False)
+    fake = FakeGoogle()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Pfad: /<endpunkt>/json
+            code, daten = fake.antwort(urlparse(self.path).path.strip("/").split("/")[0])
+            body = json.dumps(daten).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake.pausen = []
+    fake.client = places.PlacesClient(base_url=f"http://127.0.0.1:{server.server_address[1]}",
+                                      sleep=fake.pausen.append)
+    places.set_client(fake.client)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+def _handwerker(*namen):
+    return pd.DataFrame({"Handwerker_Name": list(namen), "PLZ_HW": "10115", "Land": "DE",
+                         "HW_ID": range(1, len(namen) + 1)})
+
+
+def _bulk(places, df):
+    return places.lade_handwerker_bulk(df, max_parallel=1, requests_per_second=1000)
+
+
+def test_bulk_laedt_und_cached(places, google):
+    ergebnis = _bulk(places, _handwerker("Maler Müller"))
+    assert ergebnis["status"].tolist() == ["OK"]
+    assert ergebnis["rating"].tolist() == [4.5]
+    assert ergebnis["hw_id"].tolist() == [1]
+    assert google.anfragen == ["textsearch", "details"]
+    assert places.google_calls_this_month() == 2
+
+    # Zweiter Lauf: frischer Cache-Eintrag, keine weitere Anfrage
+    assert _bulk(places, _handwerker("Maler Müller")).empty
+    assert len(google.anfragen) == 2
+
+
+def test_bulk_wiederholt_429_und_5xx_mit_backoff(places, google):
+    google.antworten["textsearch"] = [(429, {}), (429, {}), OK_SUCHE]
+    google.antworten["details"] = [(503, {}), OK_DETAILS]
+    ergebnis = _bulk(places, _handwerker("Maler Müller"))
+
+    assert ergebnis["status"].tolist() == ["OK"]
+    assert google.anfragen == ["textsearch"] * 3 + ["details"] * 2
+    # Full Jitter: je Wiederholung zwischen 0 und dem exponentiellen Deckel
+    client = google.client
+    deckel = [min(client.backoff_max, client.backoff_basis * 2 ** v) for v in (0, 1, 0)]
+    assert len(google.pausen) == 3
+    assert all(0 <= p <= d for p, d in zip(google.pausen, deckel))
+    metriken = client.metriken()
+    assert metriken["textsearch"]["wiederholungen"] == 2
+    assert metriken["details"]["wiederholungen"] == 1
+    # Jeder HTTP-Versuch zählt gegen das Monatslimit
+    assert places.google_calls_this_month() == 5
+
+
+def test_bulk_over_query_limit_wird_wiederholt(places, google):
+    google.antworten["textsearch"] = [(200, {"status": "OVER_QUERY_LIMIT"}), OK_SUCHE]
+    assert _bulk(places, _handwerker("Maler Müller"))["status"].tolist() == ["OK"]
+    assert google.anfragen == ["textsearch", "textsearch", "details"]
+
+
+def test_bulk_429_bis_zum_letzten_versuch(places, google):
+    google.antworten["textsearch"] = [(429, {})]
+    ergebnis = _bulk(places, _handwerker("Maler Müller"))
+
+    assert ergebnis["status"].tolist() == ["ERROR"]
+    assert "429" in ergebnis["error_message"].iloc[0]
+    assert google.anfragen == ["textsearch"] * google.client.max_versuche
+    assert len(google.pausen) == google.client.max_versuche - 1
+    assert places.google_calls_this_month() == google.client.max_versuche
+
+
+def test_bulk_quota_erschoepft(places, google, monkeypatch):
+    # Budget für drei HTTP-Anfragen: der erste Handwerker braucht zwei, beim zweiten scheitern die Details
+    monkeypatch.setattr(places, "MAX_CALLS_PER_MONTH", 3)
+    ergebnis = _bulk(places, _handwerker("Maler Müller", "Dach Schmidt"))
+
+    assert ergebnis["status"].tolist() == ["OK", "QUOTA"]
+    assert google.anfragen == ["textsearch", "details", "textsearch"]
+    assert places.google_calls_this_month() == 3
+    assert places.verbleibendes_budget() == 0
+
+    # QUOTA-Einträge sperren bis retry_after, auch ohne Budget geht keine Anfrage raus
+    assert _bulk(places, _handwerker("Maler Müller", "Dach Schmidt")).empty
+    assert len(google.anfragen) == 3
+
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# Fehlgeschlagenes Neuladen: ein gültiger OK-Eintrag bleibt stehen (stale-while-revalidate)
+
+HW = ("Maler Müller", "10115", "DE")
+
+
+def _warte_bis(bedingung, sekunden=5.0):
+    ende = time.monotonic() + sekunden
+    while not bedingung():
+        assert time.monotonic() < ende, "Zeitüberschreitung"
+        time.sleep(0.01)
+
+
+def test_fehler_beim_neuladen_behaelt_ok_eintrag(places, google):
+    _bulk(places, _handwerker("Maler Müller"))
+    google.antworten["details"] = [(500, {})]
+
+    row = places.get_handwerker_data(*HW, force_api=True)
+    assert (row["status"], row["source"], row["rating"]) == ("OK", "cache", 4.5)
+    eintrag = places.cache_eintrag(*HW)
+    assert (eintrag["status"], eintrag["rating"], eintrag["fehler_status"]) == ("OK", 4.5, "ERROR")
+    assert pd.notna(eintrag["fehler_updated"])
+
+    # bis zum Ablauf der Fehler-TTL kein neuer Versuch, auch nicht mit force_api
+    anzahl = len(google.anfragen)
+    assert places.get_handwerker_data(*HW, force_api=True)["rating"] == 4.5
+    assert len(google.anfragen) == anzahl
+
+    # danach wieder abfragen; ein Erfolg löscht den Fehler-Vermerk
+    google.antworten["details"] = [(200, {"status": "OK", "result": {"rating": 4.8, "user_ratings_total": 13}})]
+    row = places.get_handwerker_data(*HW, force_api=True, policy=places.CachePolicy(ttl_fehler=pd.Timedelta(0)))
+    assert (row["source"], row["rating"]) == ("google", 4.8)
+    eintrag = places.cache_eintrag(*HW)
+    assert eintrag["fehler_status"] is None and pd.isna(eintrag["fehler_updated"])
+
+
+def test_quota_beim_neuladen_behaelt_ok_eintrag(places, google, monkeypatch):
+    _bulk(places, _handwerker("Maler Müller"))
+    monkeypatch.setattr(places, "MAX_CALLS_PER_MONTH", places.google_calls_this_month())
+
+    row = places.get_handwerker_data(*HW, force_api=True)
+    assert (row["status"], row["rating"]) == ("OK", 4.5)
+    assert places.cache_eintrag(*HW)["fehler_status"] == "QUOTA"
+    assert len(google.anfragen) == 2
+
+
+def test_hintergrund_zaehlt_nur_erfolgreiche_aktualisierungen(places, google):
+    _bulk(places, _handwerker("Maler Müller"))
+    eintrag = places.cache_eintrag(*HW)
+    eintrag["bewertung_updated"] = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=60)
+    places.speichere_eintraege([eintrag])
+    google.antworten["details"] = [(500, {})]
+
+    akt = places.HintergrundAktualisierer(requests_per_second=1000, policy=places.CachePolicy(ttl_fehler=pd.Timedelta(0)))
+    akt.vormerken([HW], [HW])
+    _warte_bis(lambda: places.cache_eintrag(*HW)["fehler_status"] == "ERROR")
+    time.sleep(0.1)
+    assert akt.generation == 0
+    assert places.cache_eintrag(*HW)["rating"] == 4.5
+
+    google.antworten["details"] = [OK_DETAILS]
+    akt.vormerken([HW], [HW])
+    _warte_bis(lambda: akt.generation == 1)
+    assert places.cache_eintrag(*HW)["fehler_status"] is None
@@ -0,0 +1,15 @@
+import importlib
+
+import pytest
+
+
+@pytest.mark.parametrize("modul", ["Preiszuverlaessigkeit", "data_loader", "Auftrags_und_Positionsdaten"])
+def test_modul_importierbar(modul):
+    # Builder und Dashboard importieren diese Module beim Start; ein falscher Modulname fällt hier auf
+    importlib.import_module(modul)
+
+
+def test_builder_einstiegspunkt():
+    builder = importlib.import_module("Auftrags_und_Positionsdaten")
+    assert callable(builder.generate_parquet_files)
+    assert callable(builder.verhaeltnis)
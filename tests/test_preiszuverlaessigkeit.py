@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import Preiszuverlaessigkeit as pz
+
+
+def _skalar(p, n, z):
+    return np.array([pz.wilson_lower_bound(float(a), int(b), z) for a, b in zip(p, n)])
+
+
+@pytest.mark.parametrize("z", [1.0, 1.64, 1.96])
+def test_wilson_np_zufaellig_wie_skalar(z):
+    rng = np.random.default_rng(42)
+    p = rng.uniform(0, 1, 5000)
+    n = rng.integers(1, 500, 5000)
+    np.testing.assert_allclose(pz.wilson_lower_bound_np(p, n, z), _skalar(p, n, z), rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize("p, n", [
+    (0.0, 0), (1.0, 0), (0.5, 0),      # n = 0
+    (0.5, -3),                         # n < 0
+    (0.0, 1), (0.0, 50),               # p = 0
+    (1.0, 1), (1.0, 50), (1.0, 10**6), # p = 1
+    (1e-12, 1), (0.999999, 2),
+])
+def test_wilson_np_randfaelle_wie_skalar(p, n):
+    np_wert = pz.wilson_lower_bound_np([p], [n])
+    assert np_wert.shape == (1,)
+    assert np_wert[0] == pytest.approx(pz.wilson_lower_bound(p, n), rel=1e-12, abs=1e-15)
+
+
+def test_wilson_np_gemischtes_array():
+    p = np.array([0.0, 1.0, 0.5, 1.0, 0.3])
+    n = np.array([0, 0, 0, 20, 20])
+    np.testing.assert_allclose(pz.wilson_lower_bound_np(p, n), _skalar(p, n, 1.64), rtol=1e-12, atol=1e-15)
+    assert np.all(pz.wilson_lower_bound_np(p, n)[:3] == 0.0)
+
+
+def test_wilson_np_ergebnis_im_einheitsintervall():
+    rng = np.random.default_rng(7)
+    p, n = rng.uniform(0, 1, 1000), rng.integers(0, 100, 1000)
+    wert = pz.wilson_lower_bound_np(p, n)
+    assert np.all((wert >= 0) & (wert <= p))